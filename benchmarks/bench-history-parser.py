@@ -0,0 +1,155 @@
+#!/usr/bin/env python
+
+# bench-history-parser.py
+#
+# Benchmarks the `sscm history` parser of export-surround-to-git.py against the original (quadratic) parser.
+#
+# Runs both parsers over every recorded `sscm history` output in benchmarks/history, plus a series of generated
+# outputs with increasingly long check-in comments, and reports lines/sec for each.
+#
+# Usage:
+#   bench-history-parser.py [--repeat N] [--comment-lines N [N ...]]
+
+
+from __future__ import print_function
+
+import os
+import re
+import glob
+import time
+import argparse
+
+
+benchDir = os.path.dirname(os.path.abspath(__file__))
+
+
+def load_exporter():
+    # the script name isn't a valid module name, so load it by path
+    path = os.path.join(benchDir, os.pardir, "export-surround-to-git.py")
+    try:
+        from importlib.machinery import SourceFileLoader
+        return SourceFileLoader("export_surround_to_git", path).load_module()
+    except ImportError:
+        import imp
+        return imp.load_source("export_surround_to_git", path)
+
+
+exporter = load_exporter()
+histRegex = exporter.histRegex
+
+
+# the parser as it was before the single-pass rewrite, kept verbatim (apart from taking 'lines' directly) for reference.
+# NOTE this re-joins every suffix of the accumulated comment on every comment line, which is what makes it quadratic.
+def parse_history_lines_old(lines):
+    versionList = []
+    comment = None
+    bFoundOne = False
+    for line in lines:
+        result = histRegex.search(line)
+        if result:
+            if bFoundOne:
+                versionList.append((timestamp, action, origFile, int(version), author, comment, data))
+            bFoundOne = True
+            action = result.group("action")
+            origFile = result.group("from")
+            to = result.group("to")
+            author = result.group("author")
+            version = result.group("version")
+            timestamp = result.group("timestamp")
+            comment = None
+            if origFile and to:
+                data = to
+            else:
+                data = result.group("data")
+        else:
+            if not comment:
+                comment = re.sub(r"^ Comments \- ", "", line, count=1)
+            else:
+                comment += "\n" + line
+
+                commentLines = [real_line for real_line in comment.split('\n') if real_line]
+                substrings = []
+                for i in range(len(commentLines) - 1):
+                    substrings.append('\n'.join(commentLines[i:len(commentLines)]))
+                for substring in substrings:
+                    result = histRegex.search(substring)
+                    if result:
+                        if i == 0:
+                            comment = None
+                        else:
+                            comment = '\n'.join(commentLines[0:i - 1])
+
+                        if bFoundOne:
+                            versionList.append((timestamp, action, origFile, int(version), author, comment, data))
+                        bFoundOne = True
+                        action = result.group("action")
+                        origFile = result.group("from")
+                        to = result.group("to")
+                        author = result.group("author")
+                        version = result.group("version")
+                        timestamp = result.group("timestamp")
+                        comment = None
+                        if origFile and to:
+                            data = to
+                        else:
+                            data = result.group("data")
+                        break
+
+    if bFoundOne:
+        versionList.append((timestamp, action, origFile, int(version), author, comment, data))
+
+    return versionList
+
+
+def load_corpus():
+    # recorded outputs, minus the 4 header lines (the same as `tail -n +5`)
+    corpus = []
+    for path in sorted(glob.glob(os.path.join(benchDir, "history", "*.txt"))):
+        with open(path) as f:
+            lines = f.read().split('\n')[4:]
+        corpus.append((os.path.basename(path), [line for line in lines if line]))
+    return corpus
+
+
+def generate_long_comment(commentLines):
+    # a single check-in with a pasted comment of the given length, followed by a couple of ordinary versions
+    lines = ["checkin                                  jdoe             3  03/04/2015 6:12 PM",
+             " Comments - Pasted log follows:"]
+    for i in range(commentLines):
+        lines.append(" line %d of a long pasted comment, with some text to make it realistically wide" % (i + 1))
+    lines += ["checkin                                  jelchison        2  03/01/2015 10:00 AM",
+              "add                                      jelchison        1  02/27/2015 9:00 AM",
+              " Comments - Initial import"]
+    return lines
+
+
+def measure(parser, lines, repeat):
+    # returns (lines/sec, result)
+    start = time.time()
+    for i in range(repeat):
+        result = parser(lines)
+    elapsed = max(time.time() - start, 1e-9)
+    return len(lines) * repeat / elapsed, result
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmarks the old and new `sscm history` parsers.')
+    parser.add_argument('--repeat', type=int, default=20, help='Number of times each input is parsed (default: 20)')
+    parser.add_argument('--comment-lines', type=int, nargs='+', default=[50, 100, 200], help='Lengths of the generated long comments (default: 50 100 200)')
+    args = parser.parse_args()
+
+    inputs = load_corpus()
+    for commentLines in args.comment_lines:
+        inputs.append(("generated, %d-line comment" % commentLines, generate_long_comment(commentLines)))
+
+    print("%-32s %8s %14s %14s %8s  %s" % ("input", "lines", "old lines/s", "new lines/s", "speedup", "same result"))
+    for name, lines in inputs:
+        # the old parser gets slow quickly, so run it fewer times on big inputs
+        oldRate, oldResult = measure(parse_history_lines_old, lines, max(1, args.repeat * 50 // max(50, len(lines))))
+        newRate, newResult = measure(exporter.parse_history_lines, lines, args.repeat)
+        # NOTE the old parser truncates the comment preceding a wrapped version line, so those inputs differ
+        print("%-32s %8d %14.0f %14.0f %7.1fx  %s" % (name, len(lines), oldRate, newRate, newRate / oldRate, "yes" if oldResult == newResult else "no"))
+
+
+if __name__ == "__main__":
+    main()
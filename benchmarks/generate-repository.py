@@ -0,0 +1,236 @@
+#!/usr/bin/env python
+
+# generate-repository.py
+#
+# Generates a synthetic Surround repository for benchmarks/fake-sscm to serve.
+#
+# The repository has N files under a single mainline, with about M versions each (spread over the mainline and its
+# baseline branches), B baseline and S snapshot branches, renames, deletes, check-ins of several files at once,
+# long (multi-line) comments and large binaries.  some files are deleted from a branch right after a snapshot of it
+# is taken, so that they are only listed on the snapshot, which has no history of its own.
+#
+# It is described by a JSON file.  file contents are not stored, but generated by the fake from a seed, so even big
+# repositories stay small on disk.
+#
+# Usage:
+#   generate-repository.py [options] repository.json
+#
+# JSON layout:
+#   {"mainline": name, "path": repository path,
+#    "branches": {name: {"type": "mainline" | "baseline" | "snapshot", "parent": name or null}},
+#    "files": {branch: {path: {"history": [event, ...],      oldest first, only the branch's own events
+#                              "contents": [[version, seed, size, binary], ...],   including inherited versions
+#                              "deleted": bool}}}}
+#   where an event is {"action", "v", "author", "time"} plus "comment", "data" (branch) or "from"/"to" (rename).
+
+
+from __future__ import print_function
+
+import json
+import math
+import random
+import argparse
+import datetime
+
+
+authors = ["jelchison", "asmith", "bjones", "cnguyen", "dgarcia", "emiller", "fwong", "gpatel"]
+
+words = ["fix", "build", "merge", "update", "refactor", "cleanup", "release", "crash", "parser", "config", "installer",
+         "driver", "timeout", "review", "feedback", "customer", "issue", "regression", "logging", "cache", "port",
+         "window", "layout", "report", "query", "schema", "startup", "shutdown", "memory", "leak", "thread", "lock"]
+
+
+def make_comment(rng, length):
+    # a comment of about 'length' characters, wrapped at 70 columns like a pasted description
+    if length <= 0:
+        return None
+    text = []
+    while sum(len(word) + 1 for word in text) < length:
+        text.append(rng.choice(words))
+    lines = []
+    line = ""
+    for word in text:
+        if line and len(line) + len(word) + 1 > 70:
+            lines.append(line)
+            line = word
+        else:
+            line = (line + " " + word).strip()
+    lines.append(line)
+    return "\n".join(lines)
+
+
+class Generator(object):
+    def __init__(self, args):
+        self.args = args
+        self.rng = random.Random(args.seed)
+        self.time = datetime.datetime(2014, 1, 1, 9, 0)
+        self.branches = {args.mainline: {"type": "mainline", "parent": None}}
+        self.files = {args.mainline: {}}
+        self.writable = [args.mainline]
+        self.numRenamed = 0
+
+    def tick(self):
+        self.time = self.time + datetime.timedelta(minutes=self.rng.randint(1, 90))
+        return self.time.strftime("%m/%d/%Y %I:%M %p")
+
+    def comment(self):
+        # most comments are short, some are long
+        if self.rng.random() < 0.1:
+            return make_comment(self.rng, self.args.comment_length)
+        return make_comment(self.rng, self.rng.randint(0, 60))
+
+    def size(self, path):
+        if path.endswith(".bin"):
+            return self.args.binary_size
+        return self.rng.randint(200, 4000)
+
+    def active(self, branch):
+        return sorted(path for path, entry in self.files[branch].items() if not entry["deleted"])
+
+    def add_version(self, branch, path, action, author, time, comment):
+        entry = self.files[branch][path]
+        version = entry["contents"][-1][0] + 1 if entry["contents"] else 1
+        seed = "%s:%s:%d" % (branch, path, version)
+        entry["contents"].append([version, seed, self.size(path), path.endswith(".bin")])
+        event = {"action": action, "v": version, "author": author, "time": time}
+        if comment:
+            event["comment"] = comment
+        entry["history"].append(event)
+
+    def add_files(self):
+        mainline = self.args.mainline
+        paths = []
+        for i in range(self.args.files):
+            extension = "bin" if i < self.args.binaries else "txt"
+            paths.append("%s/dir%02d/file%05d.%s" % (self.args.path, i % self.args.directories, i, extension))
+        # initial import, in check-ins of up to 25 files
+        for start in range(0, len(paths), 25):
+            time = self.tick()
+            author = self.rng.choice(authors)
+            comment = self.comment()
+            for path in paths[start:start + 25]:
+                self.files[mainline][path] = {"history": [], "contents": [], "deleted": False}
+                self.add_version(mainline, path, "add", author, time, comment)
+
+    def checkin(self):
+        branch = self.rng.choice(self.writable)
+        paths = self.active(branch)
+        if not paths:
+            return 0
+        time = self.tick()
+        author = self.rng.choice(authors)
+        comment = self.comment()
+        chosen = self.rng.sample(paths, min(len(paths), self.rng.randint(1, 5)))
+        for path in chosen:
+            self.add_version(branch, path, "checkin", author, time, comment)
+        return len(chosen)
+
+    def create_branch(self, branchType, name):
+        parent = self.rng.choice(self.writable)
+        time = self.tick()
+        author = self.rng.choice(authors)
+        self.branches[name] = {"type": branchType, "parent": parent}
+        self.files[name] = {}
+        for path in self.active(parent):
+            entry = self.files[parent][path]
+            version = entry["contents"][-1][0]
+            entry["history"].append({"action": "add to branch", "v": version, "author": author, "time": time, "data": name})
+            self.files[name][path] = {"history": [], "contents": [list(content) for content in entry["contents"]], "deleted": False}
+        if branchType == "baseline":
+            self.writable.append(name)
+        elif self.args.snapshot_deletes:
+            # files that live on in the snapshot only
+            for path in self.rng.sample(self.active(parent), min(len(self.active(parent)), self.args.snapshot_deletes)):
+                self.delete_file(parent, path)
+
+    def bump_version(self, entry):
+        # renames and deletes get a version of their own, with the content of the previous one
+        content = list(entry["contents"][-1])
+        content[0] = content[0] + 1
+        entry["contents"].append(content)
+        return content[0]
+
+    def rename(self):
+        branch = self.rng.choice(self.writable)
+        paths = self.active(branch)
+        if not paths:
+            return
+        path = self.rng.choice(paths)
+        directory, name = path.rsplit("/", 1)
+        self.numRenamed = self.numRenamed + 1
+        newName = "renamed%04d_%s" % (self.numRenamed, name)
+        entry = self.files[branch].pop(path)
+        version = self.bump_version(entry)
+        entry["history"].append({"action": "renamed", "v": version, "author": self.rng.choice(authors), "time": self.tick(), "from": name, "to": newName})
+        self.files[branch][directory + "/" + newName] = entry
+
+    def delete(self):
+        branch = self.rng.choice(self.writable)
+        paths = self.active(branch)
+        if not paths:
+            return
+        self.delete_file(branch, self.rng.choice(paths))
+
+    def delete_file(self, branch, path):
+        entry = self.files[branch][path]
+        version = self.bump_version(entry)
+        entry["history"].append({"action": "delete", "v": version, "author": self.rng.choice(authors), "time": self.tick()})
+        entry["deleted"] = True
+
+    def generate(self):
+        self.add_files()
+
+        # check-ins touch 3 files on average
+        numCheckins = int(math.ceil(self.args.files * max(0, self.args.versions - 1) / 3.0))
+        operations = ["checkin"] * numCheckins + ["baseline"] * self.args.baselines + ["snapshot"] * self.args.snapshots + \
+                     ["rename"] * self.args.renames + ["delete"] * self.args.deletes
+        self.rng.shuffle(operations)
+
+        numBaselines = 0
+        numSnapshots = 0
+        for operation in operations:
+            if operation == "checkin":
+                self.checkin()
+            elif operation == "baseline":
+                numBaselines = numBaselines + 1
+                self.create_branch("baseline", "baseline%02d" % numBaselines)
+            elif operation == "snapshot":
+                numSnapshots = numSnapshots + 1
+                self.create_branch("snapshot", "snapshot%02d" % numSnapshots)
+            elif operation == "rename":
+                self.rename()
+            elif operation == "delete":
+                self.delete()
+
+        return {"mainline": self.args.mainline, "path": self.args.path, "branches": self.branches, "files": self.files}
+
+
+def parse_arguments(argv=None):
+    parser = argparse.ArgumentParser(description='Generates a synthetic Surround repository for benchmarks/fake-sscm.')
+    parser.add_argument('--files', type=int, default=200, help='Number of files (default: 200)')
+    parser.add_argument('--versions', type=int, default=5, help='Average number of versions per file (default: 5)')
+    parser.add_argument('--baselines', type=int, default=3, help='Number of baseline branches (default: 3)')
+    parser.add_argument('--snapshots', type=int, default=3, help='Number of snapshot branches (default: 3)')
+    parser.add_argument('--renames', type=int, default=10, help='Number of renames (default: 10)')
+    parser.add_argument('--deletes', type=int, default=10, help='Number of deletes (default: 10)')
+    parser.add_argument('--snapshot-deletes', type=int, default=2, help='Number of files deleted from the parent branch right after each snapshot (default: 2)')
+    parser.add_argument('--comment-length', type=int, default=2000, help='Length of the long comments, in characters (default: 2000)')
+    parser.add_argument('--binaries', type=int, default=5, help='Number of files that are large binaries (default: 5)')
+    parser.add_argument('--binary-size', type=int, default=4 * 1024 * 1024, help='Size of each binary, in bytes (default: 4 MiB)')
+    parser.add_argument('--directories', type=int, default=10, help='Number of directories the files are spread over (default: 10)')
+    parser.add_argument('--mainline', default='Bench', help='Name of the mainline branch (default: Bench)')
+    parser.add_argument('--path', default='Bench', help='Repository path of the files (default: Bench)')
+    parser.add_argument('--seed', type=int, default=1, help='Random seed (default: 1)')
+    parser.add_argument('output', help='Path of the JSON file to write')
+    return parser.parse_args(argv)
+
+
+def main():
+    args = parse_arguments()
+    repository = Generator(args).generate()
+    with open(args.output, "w") as f:
+        json.dump(repository, f, sort_keys=True)
+
+
+if __name__ == "__main__":
+    main()
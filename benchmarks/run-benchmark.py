@@ -0,0 +1,217 @@
+#!/usr/bin/env python
+
+# run-benchmark.py
+#
+# End-to-end benchmark of export-surround-to-git.py against a synthetic repository, without a Surround server.
+#
+# Generates a repository (see generate-repository.py), then runs `parse`, and `export` piped into a real
+# `git fast-import`, with benchmarks/fake-sscm standing in for sscm.  a run fails if the parse missed the history of
+# any (branch, file) pair in the synthetic repository.  throughput is sampled during each phase via
+# the exporter's --stats reports.  the results of every run are appended to a JSON-lines file, and compared with the
+# previous run of the same configuration, so that regressions are visible.
+#
+# Usage:
+#   run-benchmark.py [generator options] [--jobs N] [--prefetch N] [--extra-args "..."] [--results FILE]
+#
+# e.g.
+#   run-benchmark.py --files 1000 --versions 10 --jobs 8 --prefetch 32
+
+
+from __future__ import print_function
+
+import os
+import sys
+import json
+import time
+import shlex
+import shutil
+import sqlite3
+import tempfile
+import argparse
+import subprocess
+
+
+benchDir = os.path.dirname(os.path.abspath(__file__))
+exporterPath = os.path.join(benchDir, os.pardir, "export-surround-to-git.py")
+fakeSscmPath = os.path.join(benchDir, "fake-sscm")
+generatorPath = os.path.join(benchDir, "generate-repository.py")
+
+# options that are passed on to generate-repository.py, and identify the configuration of a run
+generatorOptions = [("files", 200), ("versions", 5), ("baselines", 3), ("snapshots", 3), ("renames", 10), ("deletes", 10),
+                    ("snapshot-deletes", 2), ("comment-length", 2000), ("binaries", 5), ("binary-size", 4 * 1024 * 1024), ("seed", 1)]
+
+
+def read_stats(statsPath):
+    # the exporter appends one JSON object per report.  returns them grouped by phase.
+    reports = {}
+    if os.path.isfile(statsPath):
+        with open(statsPath) as f:
+            for line in f:
+                report = json.loads(line)
+                reports.setdefault(report["phase"], []).append(report)
+    return reports
+
+
+def summarize_phase(reports, counter):
+    # final throughput of a phase, plus 'counter' over time from the interim reports
+    final = [report for report in reports if report["final"]][-1]
+    series = [[round(report["elapsed"], 2), report["counters"].get(counter, report["timers"].get(counter, {}).get("count", 0))] for report in reports]
+    timers = final["timers"]
+    return {"elapsed": final["elapsed"],
+            "counters": final["counters"],
+            "per_second": final["per_second"],
+            "sscm_seconds": sum(timer["seconds"] for name, timer in timers.items() if name.startswith("sscm ")),
+            "sscm_calls": sum(timer["count"] for name, timer in timers.items() if name.startswith("sscm ")),
+            "over_time": {counter: series}}
+
+
+def find_missing_history(repositoryPath, databasePath):
+    # (branch, path) pairs of the synthetic repository whose file operations didn't make it into the database, e.g.
+    # because the parse never asked that branch about that file.  branch creations are recorded under the top path,
+    # so only pairs with file operations of their own are checked.  files are known by the names `sscm ls` lists,
+    # so (as when asking every branch about every file) a file that no branch lists under this name is not expected.
+    with open(repositoryPath) as f:
+        repository = json.load(f)
+    database = sqlite3.connect(databasePath)
+    try:
+        parsed = set(database.execute('''SELECT DISTINCT branch, path FROM operations'''))
+    finally:
+        database.close()
+    listed = set(path for files in repository["files"].values() for path, entry in files.items() if not entry["deleted"])
+    missing = []
+    for branch, files in sorted(repository["files"].items()):
+        for path, entry in sorted(files.items()):
+            if path in listed and any(event["action"] != "add to branch" for event in entry["history"]) and (branch, path) not in parsed:
+                missing.append((branch, path))
+    return missing
+
+
+def git_revision():
+    try:
+        return subprocess.check_output(["git", "-C", benchDir, "rev-parse", "--short", "HEAD"], universal_newlines=True).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run(args, workDir):
+    env = dict(os.environ)
+    env["FAKE_SSCM_REPO"] = os.path.join(workDir, "repository.json")
+    statsPath = os.path.join(workDir, "stats.jsonl")
+    databasePath = os.path.join(workDir, "benchmark.db")
+    gitDir = os.path.join(workDir, "git")
+    logPath = os.path.join(workDir, "export.log")
+
+    sys.stderr.write("[*] Generating repository in %s ...\n" % workDir)
+    generatorArgs = []
+    for name, default in generatorOptions:
+        generatorArgs += ["--" + name, str(getattr(args, name.replace('-', '_')))]
+    subprocess.check_call([sys.executable, generatorPath] + generatorArgs + [env["FAKE_SSCM_REPO"]])
+
+    common = [sys.executable, exporterPath, "--sscm", fakeSscmPath, "--stats", statsPath, "--stats-interval", str(args.interval),
+              "-j", str(args.jobs)] + shlex.split(args.extra_args)
+
+    with open(logPath, "w") as log:
+        sys.stderr.write("[*] Parsing ...\n")
+        start = time.time()
+        subprocess.check_call(common + ["-m", "Bench", "-p", "Bench", "-d", databasePath, "parse"], cwd=workDir, env=env, stderr=log)
+        parseSeconds = time.time() - start
+        missing = find_missing_history(env["FAKE_SSCM_REPO"], databasePath)
+        if missing:
+            raise Exception("Parse lost the history of %d (branch, file) pairs, e.g. %s" % (len(missing), ", ".join("'%s' on '%s'" % (path, branch) for branch, path in missing[:5])))
+
+        sys.stderr.write("[*] Exporting into git fast-import ...\n")
+        subprocess.check_call(["git", "init", "-q", gitDir])
+        start = time.time()
+        exporter = subprocess.Popen(common + ["--prefetch", str(args.prefetch), "-d", databasePath, "export"], cwd=gitDir, env=env, stdout=subprocess.PIPE, stderr=log)
+        # fast-import echoes the exporter's `progress` commands on its stdout
+        importer = subprocess.Popen(["git", "fast-import", "--quiet"], cwd=gitDir, stdin=exporter.stdout, stdout=log, stderr=log)
+        exporter.stdout.close()
+        importer.wait()
+        exporter.wait()
+        exportSeconds = time.time() - start
+    if exporter.returncode or importer.returncode:
+        raise Exception("Export failed (exporter %d, git fast-import %d), see %s" % (exporter.returncode, importer.returncode, logPath))
+
+    commits = int(subprocess.check_output(["git", "rev-list", "--all", "--count"], cwd=gitDir, universal_newlines=True))
+    reports = read_stats(statsPath)
+    return {"time": time.time(),
+            "revision": git_revision(),
+            "config": dict([(name, getattr(args, name.replace('-', '_'))) for name, default in generatorOptions] +
+                           [("jobs", args.jobs), ("prefetch", args.prefetch), ("extra_args", args.extra_args)]),
+            "parse": dict(summarize_phase(reports["parse"], "find_all_file_versions"), wall_seconds=parseSeconds),
+            "export": dict(summarize_phase(reports["export"], "records exported"), wall_seconds=exportSeconds),
+            "commits": commits,
+            "repository_bytes": directory_size(os.path.join(gitDir, ".git"))}
+
+
+def directory_size(path):
+    total = 0
+    for root, dirs, files in os.walk(path):
+        for name in files:
+            total = total + os.path.getsize(os.path.join(root, name))
+    return total
+
+
+def find_previous(resultsPath, config):
+    # the last recorded run with the same configuration, if any
+    previous = None
+    if os.path.isfile(resultsPath):
+        with open(resultsPath) as f:
+            for line in f:
+                result = json.loads(line)
+                if result["config"] == config:
+                    previous = result
+    return previous
+
+
+def print_result(result, previous):
+    def rate(phase, counter):
+        return result[phase]["counters"].get(counter, 0) / max(result[phase]["wall_seconds"], 1e-9)
+
+    def change(phase, counter):
+        if not previous:
+            return ""
+        before = previous[phase]["counters"].get(counter, 0) / max(previous[phase]["wall_seconds"], 1e-9)
+        if not before:
+            return ""
+        return "  (%+.1f%% vs. %s)" % (100.0 * (rate(phase, counter) - before) / before, previous["revision"])
+
+    print("revision:        %s" % result["revision"])
+    print("parse:           %.1fs, %d sscm calls (%.1fs), %.0f records/s%s" % (result["parse"]["wall_seconds"], result["parse"]["sscm_calls"], result["parse"]["sscm_seconds"], rate("parse", "records written"), change("parse", "records written")))
+    print("export:          %.1fs, %d sscm calls (%.1fs), %.0f records/s%s" % (result["export"]["wall_seconds"], result["export"]["sscm_calls"], result["export"]["sscm_seconds"], rate("export", "records exported"), change("export", "records exported")))
+    print("blob bytes:      %d emitted, %d fetched" % (result["export"]["counters"].get("blob bytes emitted", 0), result["export"]["counters"].get("bytes fetched", 0)))
+    print("git:             %d commits, %d bytes" % (result["commits"], result["repository_bytes"]))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmarks parse and export against a synthetic repository, served by benchmarks/fake-sscm.')
+    for name, default in generatorOptions:
+        parser.add_argument('--' + name, type=int, default=default, help='Passed to generate-repository.py (default: %d)' % default)
+    parser.add_argument('--jobs', type=int, default=1, help='-j/--jobs of the exporter (default: 1)')
+    parser.add_argument('--prefetch', type=int, default=0, help='--prefetch of the exporter (default: 0)')
+    parser.add_argument('--extra-args', default='', help='Further options for the exporter, e.g. "--bulk-fetch --coalesce-window 60"')
+    parser.add_argument('--interval', type=int, default=1, help='Seconds between throughput samples (default: 1)')
+    parser.add_argument('--results', default=os.path.join(benchDir, 'results.jsonl'), help='File that the results of each run are appended to (default: benchmarks/results.jsonl, which Git ignores)')
+    parser.add_argument('--keep', action='store_true', help='Keep the working directory (repository, database, Git repository and logs)')
+    args = parser.parse_args()
+
+    workDir = tempfile.mkdtemp(prefix="surround-benchmark-")
+    try:
+        result = run(args, workDir)
+    except:
+        # keep everything around for a post-mortem
+        sys.stderr.write("[*] Kept %s\n" % workDir)
+        raise
+    if args.keep:
+        sys.stderr.write("[*] Kept %s\n" % workDir)
+    else:
+        shutil.rmtree(workDir, ignore_errors=True)
+
+    previous = find_previous(args.results, result["config"])
+    with open(args.results, "a") as f:
+        f.write(json.dumps(result, sort_keys=True) + "\n")
+    print_result(result, previous)
+
+
+if __name__ == "__main__":
+    main()
@@ -30,7 +30,6 @@ VERSION = '0.5.0'
 
 # Environment:  For now, this script requires:
 #   * Python 2.7
-#   * Bash
 #   * sscm command-line client (in path)
 
 # Last tested using:
@@ -51,6 +50,18 @@ import datetime
 import sqlite3
 import os
 import shutil
+import hashlib
+import json
+import io
+import stat
+import collections
+import tempfile
+import threading
+import shlex
+import heapq
+import bisect
+import multiprocessing
+from multiprocessing.pool import ThreadPool
 
 
 #
@@ -60,9 +71,65 @@ import shutil
 # temp directory in cwd, holds files fetched from Surround
 scratchDir = "scratch"
 
+# the Surround command-line client.  can be pointed at a stub for testing.
+sscmExe = "sscm"
+
+# instrumentation, gathered per phase.  statsTimers maps a name --> [count, seconds, max seconds, histogram], where the
+# histogram counts calls per latency bucket (see statsBuckets, in milliseconds, plus one for anything slower).
+# statsCounters maps a name --> running total (e.g. bytes).  names of sscm commands start with "sscm ".
+# written as JSON lines to statsFile (if any) at the end of each phase, and every statsInterval seconds during it.
+statsTimers = {}
+statsCounters = {}
+statsLock = threading.Lock()
+statsBuckets = [2 ** exponent for exponent in range(17)]
+statsFile = None
+statsInterval = 0
+statsPhase = None
+statsStart = None
+statsStopEvent = None
+statsThread = None
+
+# blobs are copied to the stream in chunks of this size, so memory usage doesn't depend on file size
+blobChunkSize = 1024 * 1024
+
+# the fast-import stream (see StreamWriter), and the size of its buffer
+stream = None
+streamBufferSize = 1024 * 1024
+
+# when set, snapshots are fetched with a single recursive `sscm get` instead of one `sscm get` per file
+bulkFetch = False
+
+# files larger than this many bytes are offloaded to Git LFS (see print_lfs_pointer()).  None disables the offload.
+# lfsMarkSet holds the marks of the pointer blobs, branchLfsDict maps branch --> paths in its tree that are pointers.
+lfsThreshold = None
+lfsMarkSet = set()
+branchLfsDict = {}
+
+# local store of fetched file versions (see BlobStore), shared by all export runs that point at the same directory
+blobStore = None
+
+# where file history comes from:  "cli" parses `sscm history` output, "sscmhist" queries the sscmhist helper (see sscmhist/).
+# sscmhistCmd is the helper's command line up to (but not including) the mainline, which is appended when it is started.
+historyBackend = "cli"
+sscmhistCmd = None
+
+# besides every 'transactionSize' records or files, the parse commits whenever the raw history it holds (see
+# DatabaseWriter.add_raw_history()) exceeds this many bytes
+rawHistoryBufferSize = 16 * 1024 * 1024
+
+# sscmhist helpers that have been started, one per parse worker.  they are shut down at the end of the parse phase.
+sscmhistClients = []
+
+# a version line in `sscm history` output can be wrapped over at most this many lines
+maxWrappedHistoryLines = 8
+
 # for efficiency, compile the history regex once beforehand
 histRegex = re.compile(r"^(?P<action>[\w]+([^\[\]\r\n]*[\w]+)?)(\[(?P<data>[^\[\]\r\n]*?)( v\. [\d]+)?\]| from \[(?P<from>[^\[\]\r\n]*)\] to \[(?P<to>[^\[\]\r\n]*)\])?([\s]+)(?P<author>[\w]+([^\[\]\r\n]*[\w]+)?)([\s]+)(?P<version>[\d]+)([\s]+)(?P<timestamp>[\w]+[^\[\]\r\n]*)$", re.MULTILINE | re.DOTALL)
 
+# every version line ends like this (the version, then the timestamp).  histRegex backtracks heavily on lines that
+# don't match, e.g. comment lines made of words only, so it is only tried on text that passes this cheap check first.
+histTailRegex = re.compile(r"[\s][\d]+[\s]+[\w][^\[\]\r\n]*\Z")
+
 # global "mark" number.  incremented before used, as 1 is minimum value allowed.
 mark = 0
 
@@ -73,6 +140,72 @@ timezone = "-0500"
 # keeps track of snapshot name --> mark number pairing
 tagDict = {}
 
+# snapshot name --> (author, timestamp, comment) of the tags still to be written.  a snapshot can be reported many
+# times (e.g. once per file, or once per shard), but fast-import only allows one update of a tag per stream.
+# so tags are written at the end of the export, pointing at the final mark in tagDict.
+snapshotTagDict = collections.OrderedDict()
+
+# blob deduplication.  a blob is emitted at most once per (branch, path, version), and at most once per content.
+# blobMarkDict maps (branch, path, version) --> mark, blobHashDict maps SHA-1 of the content --> mark.
+blobMarkDict = {}
+blobHashDict = {}
+
+# keeps track of the newest version of each file on each branch during export:  branch --> {path: version}.
+# when a branch is created, its parent and a copy of the parent's versions are saved in branchBaseDict.
+# any version at or below an inherited version is identical to the parent's, so its blob can be reused.
+branchVersionDict = {}
+branchBaseDict = {}
+
+# mirrors the Git side of each branch (or snapshot) during export:  branch --> {path: mark}, and branch --> head mark.
+# this is what lets snapshot fixups contain only the files that differ from the parent branch.
+branchTreeDict = {}
+branchHeadDict = {}
+
+# what has changed in branchTreeDict, blobHashDict and blobMarkDict since the export state was last saved, so that a
+# checkpoint only writes that (see save_export_state()).  dirtyTreeDict maps branch --> set of paths whose entry has
+# changed.  the other two list the keys that have been added.
+dirtyTreeDict = {}
+dirtyBlobHashes = []
+dirtyBlobMarks = []
+
+# how many of the latest checkpoints the export state keeps.  fast-import may not have processed the newest ones when
+# the export fails, so 'export --resume' continues from the newest one that its marks file confirms.
+# checkpointTreeKeys lists (mark, (branch, path) pairs written) of each checkpoint saved since the oldest one kept.
+checkpointsKept = 8
+checkpointTreeKeys = collections.deque()
+
+# branches that have been written to in this fast-import session.  when continuing an earlier export (see 'sync'),
+# the first commit on any other branch must name its parent explicitly, as fast-import only knows it by mark.
+sessionBranchSet = set()
+
+# (snapshot, path) pairs that have been exported in this session
+sessionSnapshotSet = set()
+
+# serializes the results that 'verify' writes to stdout
+verifyLock = threading.Lock()
+
+# databases being exported.  their 'files' tables tell which files a snapshot contains (see find_all_files_in_snapshot)
+fileIndexDatabases = []
+
+# branch catalog:  branch name --> (type, parent).  backed by the 'branches' table in the database.
+branchCatalog = {}
+branchCatalogLock = threading.Lock()
+
+# what `sscm lsbranch` appends to branch names, and what `sscm ls` appends to file names
+branchTypeRegex = re.compile(r" \((baseline|mainline|snapshot)\)$")
+lsStatusRegex = re.compile(r"unknown status.*$")
+lsVersionRegex = re.compile(r"unknown status\s+(?P<version>[\d]+)")
+
+# pulls the type and the parent branch out of `sscm branchproperty` output
+branchPropertyTypeRegex = re.compile(r"^\s*(?:branch )?type\s*:\s*(?P<type>.*?)\s*$", re.MULTILINE | re.IGNORECASE)
+branchParentRegex = re.compile(r"^\s*parent(?: branch)?\s*:\s*(?P<parent>.*?)\s*$", re.MULTILINE | re.IGNORECASE)
+
+# parse workers are numbered in the order they pick up their first (branch, file) pair.
+# this is only used to make progress output readable when running with '--jobs'.
+workerState = threading.local()
+workerCount = 0
+workerLock = threading.Lock()
+
 # actions enumeration
 class Actions:
     BRANCH_SNAPSHOT = 1
@@ -122,9 +255,14 @@ actionMap = {"add"                   : Actions.FILE_MODIFY,
 # classes
 #
 
-class DatabaseRecord:
+class DatabaseRecord(object):
+    # one of these is created per row during export, so avoid a per-instance __dict__
+    __slots__ = ('timestamp', 'action', 'mainline', 'branch', 'path', 'origPath', 'version', 'author', 'comment', 'data', 'rowid')
+
     def __init__(self, tuple):
         self.init(tuple[0], tuple[1], tuple[2], tuple[3], tuple[4], tuple[5], tuple[6], tuple[7], tuple[8], tuple[9])
+        # rows read back from the database also carry their rowid (see iterate_database_records())
+        self.rowid = tuple[10] if len(tuple) > 10 else None
 
     def init(self, timestamp, action, mainline, branch, path, origPath, version, author, comment, data):
         self.timestamp = timestamp
@@ -142,232 +280,942 @@ class DatabaseRecord:
         return (self.timestamp, self.action, self.mainline, self.branch, self.path, self.origPath, self.version, self.author, self.comment, self.data)
 
 
+class SscmhistClient(object):
+    # a long-lived sscmhist helper, which logs in once and then answers one history query per line of input.
+    # queries are answered strictly in order, so a client must only ever be used by one thread.
+    def __init__(self, cmd, mainline):
+        self.process = subprocess.Popen(cmd + [mainline], stdin=subprocess.PIPE, stdout=subprocess.PIPE, universal_newlines=True, bufsize=1)
+
+    def query(self, branch, repo, file):
+        # returns the history of a file as lists of (version, date, action, actionBranch, actionVersion, username, comment),
+        # still escaped (see sscmhist/main.c)
+        self.process.stdin.write("%s\t%s\t%s\n" % (branch, repo, file))
+        self.process.stdin.flush()
+        rows = []
+        for line in iter(self.process.stdout.readline, ''):
+            line = line.rstrip('\n')
+            if line == "END":
+                return rows
+            if line.startswith("ERROR\t"):
+                # same as the CLI backend:  report it, and carry on as if the file had no history
+                sys.stderr.write("\n" + line.split('\t', 1)[1])
+                return []
+            rows.append(line.split('\t'))
+        raise Exception("sscmhist helper exited unexpectedly: %s" % '\n'.join(['\t'.join(row) for row in rows]))
+
+    def close(self):
+        self.process.stdin.close()
+        self.process.wait()
+
+
 def verify_surround_environment():
     # verify we have sscm client installed and in PATH
-    cmd = "sscm version"
+    return (run_sscm_cmd(["version"]) == 0)
+
+
+def record_timing(name, seconds):
+    with statsLock:
+        stats = statsTimers.get(name)
+        if stats is None:
+            stats = statsTimers[name] = [0, 0.0, 0.0, [0] * (len(statsBuckets) + 1)]
+        stats[0] = stats[0] + 1
+        stats[1] = stats[1] + seconds
+        stats[2] = max(stats[2], seconds)
+        stats[3][bisect.bisect_left(statsBuckets, 1000 * seconds)] += 1
+
+
+def count_stat(name, amount=1):
+    with statsLock:
+        statsCounters[name] = statsCounters.get(name, 0) + amount
+
+
+def begin_stats_phase(phase):
+    # starts gathering statistics for a phase, and the periodic report (if requested)
+    global statsPhase, statsStart, statsStopEvent, statsThread
+
+    with statsLock:
+        statsTimers.clear()
+        statsCounters.clear()
+        statsPhase = phase
+        statsStart = time.time()
+    if statsFile and statsInterval > 0:
+        statsStopEvent = threading.Event()
+        statsThread = threading.Thread(target=stats_reporter, args=(statsStopEvent,))
+        statsThread.daemon = True
+        statsThread.start()
+
+
+def stats_reporter(stopEvent):
+    # runs on its own thread during a phase
+    while not stopEvent.wait(statsInterval):
+        write_stats_report(False)
+
+
+def end_stats_phase():
+    # writes the final report of a phase, and summarizes the sscm commands on stderr
+    global statsThread
+
+    if statsThread:
+        statsStopEvent.set()
+        statsThread.join()
+        statsThread = None
+    if statsFile:
+        write_stats_report(True)
+    with statsLock:
+        stats = sorted((name, stats) for name, stats in statsTimers.items() if name.startswith("sscm "))
+    for name, (count, seconds, maxSeconds, histogram) in stats:
+        sys.stderr.write("\n[*] %s: %d calls, %.1fs total, %.1fms average, %.1fms max" % (name, count, seconds, 1000 * seconds / count, 1000 * maxSeconds))
+
+
+def write_stats_report(final):
+    # appends one JSON object (a line) to the stats file
+    with statsLock:
+        elapsed = time.time() - statsStart
+        report = {"phase": statsPhase,
+                  "final": final,
+                  "time": time.time(),
+                  "elapsed": elapsed,
+                  "timers": dict((name, {"count": count,
+                                         "seconds": seconds,
+                                         "average": seconds / count,
+                                         "max": maxSeconds,
+                                         "histogram": {"le_ms": statsBuckets + [None], "counts": list(histogram)}})
+                                 for name, (count, seconds, maxSeconds, histogram) in statsTimers.items()),
+                  "counters": dict(statsCounters),
+                  "per_second": dict((name, value / elapsed if elapsed else None) for name, value in statsCounters.items())}
+    with open(statsFile, "a") as f:
+        f.write(json.dumps(report, sort_keys=True) + "\n")
+
+
+def run_sscm_cmd(args):
+    # runs an sscm command whose output isn't needed, and returns its exit code
+    start = time.time()
     with open(os.devnull, 'w') as fnull:
-        p = subprocess.Popen(cmd, shell=True, stdout=fnull, stderr=fnull)
+        p = subprocess.Popen([sscmExe] + args, stdout=fnull, stderr=fnull)
         p.communicate()
-        return (p.returncode == 0)
+    record_timing("sscm " + args[0], time.time() - start)
+    return p.returncode
 
 
-def get_lines_from_sscm_cmd(sscm_cmd):
-    # helper function to clean each item on a line since sscm has lots of newlines
-    p = subprocess.Popen(sscm_cmd, shell=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-    stdoutdata, stderrdata = p.communicate()
-    stderrdata = stderrdata.strip()
-    if stderrdata:
-        sys.stderr.write('\n')
-        sys.stderr.write(stderrdata)
-    return [real_line for real_line in stdoutdata.split('\n') if real_line]
+def get_lines_from_sscm_cmd(args, skip=0):
+    # runs an sscm command (without a shell), and yields the non-empty lines of its output as they arrive, without
+    # line endings.  the first 'skip' lines (e.g. a header) are dropped.  errors go straight to our stderr.
+    start = time.time()
+    p = subprocess.Popen([sscmExe] + args, stdout=subprocess.PIPE, universal_newlines=True)
+    try:
+        for line in p.stdout:
+            if skip:
+                skip = skip - 1
+                continue
+            count_stat("sscm output characters", len(line))
+            line = line.rstrip('\r\n')
+            if line:
+                yield line
+    finally:
+        p.stdout.close()
+        p.wait()
+        record_timing("sscm " + args[0], time.time() - start)
 
 
 def find_all_branches_in_mainline_containing_path(mainline, path):
     # pull out lines from `lsbranch` that are of type baseline, mainline, or snapshot.
     # no sense in adding the `-d` switch, as `sscm ls` won't list anything for deleted branches.
-    cmd = 'sscm lsbranch -b"%s" -p"%s" | sed -r \'s/ \((baseline|mainline|snapshot)\)$//g\'' % (mainline, path)
     # FTODO this command yields branches that don't include the path specified.
     # should we filter them out here?  may increase efficiency to not deal with them later.
     # NOTE: don't use '-f' with this command, as it really restricts overall usage.
-    return get_lines_from_sscm_cmd(cmd)
-
-
-def find_all_files_in_branches_under_path(mainline, branches, path):
-    fileSet = set()
+    return [branchTypeRegex.sub("", line) for line in get_lines_from_sscm_cmd(["lsbranch", "-b" + mainline, "-p" + path])]
+
+
+def find_all_files_in_branch_under_path(branch, path):
+    # yields the full path of every file that `sscm ls` lists under 'path' on 'branch'
+    for file, version in find_all_file_versions_in_branch_under_path(branch, path):
+        yield file
+
+
+def find_all_file_versions_in_branch_under_path(branch, path):
+    # yields (full path, current version) of every file that `sscm ls` lists under 'path' on 'branch'.  the version is
+    # None if `ls` doesn't show it.  directories are listed on their own line, before a section of their files.
+    # use all lines from `ls` except for the summary, and with any status stripped off.
+    for line in get_lines_from_sscm_cmd(["ls", "-b" + branch, "-p" + path, "-r"]):
+        if "Total listed files" in line:
+            continue
+        version = lsVersionRegex.search(line)
+        if version:
+            version = int(version.group("version"))
+        line = lsStatusRegex.sub("", line)
+        if not line:
+            continue
+        if line[0] != ' ':
+            lastDirectory = line
+        elif line[1] != ' ':
+            yield "%s/%s" % (lastDirectory, line.strip()), version
+
+
+def index_files_in_branches(database, branches, path):
+    # records which files each branch lists under 'path' in the 'files' table, and returns the number of pairs.
+    # only these (branch, file) pairs are known to have history.  see find_related_pairs() for deleted files.
     for branch in branches:
         sys.stderr.write("\n[*] Looking for files in branch '%s' ..." % branch)
+        database.executemany('''INSERT OR IGNORE INTO files VALUES (?, ?, ?)''', ((branch, file, version) for file, version in find_all_file_versions_in_branch_under_path(branch, path)))
+    database.commit()
+    return database.execute('''SELECT COUNT(*) FROM files''').fetchone()[0]
+
+
+def index_changed_files_in_branches(database, mainline, branches, branchOrder, path):
+    # for 'sync':  lists the files of each branch again, and queues the (branch, file) pairs that are new, whose
+    # version has changed, or that are no longer listed (e.g. deleted) for the first round of the parse.  every other
+    # pair can't have new history of its own.  returns the branches that were listed, and those of them that are new.
+    # the listing goes to a temporary table, and only replaces 'files' once the parse is complete (see
+    # save_changed_files()), so that an interrupted sync finds the same changes again.  snapshots never change, so
+    # those that were listed before are not listed again.
+    database.execute('''CREATE TEMP TABLE IF NOT EXISTS listed_files (branch TEXT NOT NULL, path TEXT NOT NULL, version INTEGER, PRIMARY KEY(branch, path))''')
+    database.execute('''DELETE FROM listed_files''')
+    listedBranches = []
+    newBranches = set()
+    for branch in branches:
+        with branchCatalogLock:
+            isSnapshot = branchCatalog.get(branch, (None, None))[0] == "snapshot"
+        isListed = database.execute('''SELECT 1 FROM files WHERE branch=? LIMIT 1''', (branch,)).fetchone() is not None
+        if isSnapshot and isListed:
+            continue
+        if not isListed:
+            newBranches.add(branch)
+        sys.stderr.write("\n[*] Looking for changed files in branch '%s' ..." % branch)
+        database.executemany('''INSERT OR IGNORE INTO listed_files VALUES (?, ?, ?)''', ((branch, file, version) for file, version in find_all_file_versions_in_branch_under_path(branch, path)))
+        listedBranches.append(branch)
+
+        # a pair is unchanged if it is listed with the version it was listed with before.  databases from before
+        # versions were kept in 'files' compare with the newest version in the history instead.
+        database.execute('''INSERT OR IGNORE INTO queued_files SELECT 0, ?, l.branch, l.path FROM listed_files l LEFT JOIN files f ON f.branch=l.branch AND f.path=l.path
+                            WHERE l.branch=? AND (l.version IS NULL OR l.version IS NOT COALESCE(f.version,
+                                (SELECT MAX(o.version) FROM operations o WHERE o.action IN (?, ?, ?) AND o.mainline=? AND o.branch=l.branch AND o.path=l.path)))''',
+                         (branchOrder[branch], branch, Actions.FILE_MODIFY, Actions.FILE_DELETE, Actions.FILE_RENAME, mainline))
+        database.execute('''INSERT OR IGNORE INTO queued_files SELECT 0, ?, f.branch, f.path FROM files f
+                            WHERE f.branch=? AND NOT EXISTS (SELECT 1 FROM listed_files l WHERE l.branch=f.branch AND l.path=f.path)''', (branchOrder[branch], branch))
+    database.commit()
+    return listedBranches, newBranches
+
 
-        # use all lines from `ls` except for a few
-        cmd = 'sscm ls -b"%s" -p"%s" -r | grep -v \'Total listed files\' | sed -r \'s/unknown status.*$//g\'' % (branch, path)
-        lines = get_lines_from_sscm_cmd(cmd)
+def save_changed_files(database, listedBranches):
+    # replaces the listing of each branch in 'files' with the one made by index_changed_files_in_branches()
+    for branch in listedBranches:
+        database.execute('''DELETE FROM files WHERE branch=?''', (branch,))
+        database.execute('''INSERT INTO files SELECT branch, path, version FROM listed_files WHERE branch=?''', (branch,))
+    database.execute('''DELETE FROM listed_files''')
+    database.commit()
 
-        # directories are listed on their own line, before a section of their files
-        for line in lines:
-            if line[0] != ' ':
-                lastDirectory = line
-            elif line[1] != ' ':
-                fileSet.add("%s/%s" % (lastDirectory, line.strip()))
 
-    return fileSet
+def find_all_files_in_snapshot(branch, path):
+    # yields the full path of every file in a snapshot under 'path', in path order.  snapshots never change, so the
+    # files listed during the parse are still accurate.  they are read lazily from the 'files' table of the databases
+    # being exported, and `sscm ls` is only asked if none of them has listed the snapshot.
+    found = False
+    for database in fileIndexDatabases:
+        # a range on the PRIMARY KEY ('0' sorts right after '/'), rather than LIKE, so that the index is used
+        for (file,) in database.execute('''SELECT path FROM files WHERE branch=? AND path>? AND path<? ORDER BY path''', (branch, path + '/', path + '0')):
+            found = True
+            yield file
+    if not found:
+        for file in find_all_files_in_branch_under_path(branch, path):
+            yield file
+
+
+def find_related_branches(branches):
+    # parent and children of each branch, according to the branch catalog.  only branches in 'branches' are included.
+    related = dict((branch, set()) for branch in branches)
+    with branchCatalogLock:
+        for branch in branches:
+            parent = branchCatalog.get(branch, (None, None))[1]
+            if parent in related:
+                related[branch].add(parent)
+                related[parent].add(branch)
+    return related
+
+
+def find_ancestor_branches(branches):
+    # parent, grandparent, etc. of each branch, according to the branch catalog.  only branches in 'branches' are included.
+    ancestors = dict((branch, []) for branch in branches)
+    with branchCatalogLock:
+        for branch in branches:
+            parent = branchCatalog.get(branch, (None, None))[1]
+            while parent in ancestors and parent != branch and parent not in ancestors[branch]:
+                ancestors[branch].append(parent)
+                parent = branchCatalog.get(parent, (None, None))[1]
+    return ancestors
+
+
+def find_related_pairs(branch, fullPathWalk, records, relatedBranches, ancestorBranches):
+    # a file that `sscm ls` doesn't list on a branch may still have history there, if it was deleted from that branch.
+    # rather than asking every branch about every file, only branches that can have history of the file are asked.
+    # a file on a branch came from its parent branch, so every ancestor is asked, even if the file has no history of
+    # its own here (e.g. on a snapshot, after the file was deleted from the mainline).  where the file does have
+    # history, its children are asked too, and any branch that the history says the file was added to.
+    related = set(ancestorBranches.get(branch, ()))
+    if records:
+        related.update(relatedBranches.get(branch, ()))
+    for record in records:
+        if record.action in (Actions.BRANCH_SNAPSHOT, Actions.BRANCH_BASELINE) and record.data in relatedBranches:
+            related.add(record.data)
+    return set((relatedBranch, fullPathWalk) for relatedBranch in related)
+
+
+def find_branch_properties(branch, repo):
+    # returns (type, parent) of a branch, as reported by `sscm branchproperty`.  parent is None if not reported.
+    result = '\n'.join(get_lines_from_sscm_cmd(["branchproperty", "-b" + branch, "-p" + repo]))
+    # only the type line counts.  the parent line names a snapshot if the branch was created from one.
+    branchType = branchPropertyTypeRegex.search(result)
+    if branchType:
+        branchType = branchType.group("type")
+    else:
+        branchType = branchParentRegex.sub("", result)
+    if branchType.lower().find("snapshot") != -1:
+        branchType = "snapshot"
+    else:
+        branchType = "baseline"
+    parent = branchParentRegex.search(result)
+    if parent:
+        parent = parent.group("parent")
+    return branchType, parent
 
 
 def is_snapshot_branch(branch, repo):
     # TODO can we eliminate 'repo' as an argument to this function?
-    cmd = 'sscm branchproperty -b"%s" -p"%s"' % (branch, repo)
-    with open(os.devnull, 'w') as fnull:
-        result = subprocess.Popen(cmd, shell=True, stdout=subprocess.PIPE, stderr=fnull).communicate()[0]
-    return result.find("snapshot") != -1
+    # branch properties come from the catalog.  only branches missing from it (e.g. deleted ones) are queried,
+    # and only once.  new entries are written to the database by save_branch_catalog().
+    with branchCatalogLock:
+        if branch in branchCatalog:
+            return branchCatalog[branch][0] == "snapshot"
+    properties = find_branch_properties(branch, repo)
+    with branchCatalogLock:
+        branchCatalog.setdefault(branch, properties)
+        return branchCatalog[branch][0] == "snapshot"
+
+
+def catalog_branches(branches, path, jobs=1):
+    # fetches the type and parent of every branch once, up front
+    sys.stderr.write("\n[*] Cataloging %d branches ..." % len(branches))
+    branches = [branch for branch in branches if branch not in branchCatalog]
+    pool = ThreadPool(max(1, jobs))
+    try:
+        results = pool.map(lambda branch: find_branch_properties(branch, path), branches)
+    finally:
+        pool.close()
+        pool.join()
+    with branchCatalogLock:
+        for branch, properties in zip(branches, results):
+            branchCatalog[branch] = properties
+
+
+def load_branch_catalog(database):
+    c = database.cursor()
+    c.execute('''CREATE TABLE IF NOT EXISTS branches (name TEXT NOT NULL PRIMARY KEY, type TEXT NOT NULL, parent TEXT)''')
+    with branchCatalogLock:
+        for name, branchType, parent in c.execute('''SELECT name, type, parent FROM branches'''):
+            branchCatalog[name] = (branchType, parent)
+
+
+def save_branch_catalog(database):
+    with branchCatalogLock:
+        rows = [(name, branchType, parent) for name, (branchType, parent) in branchCatalog.items()]
+    database.executemany('''INSERT OR REPLACE INTO branches VALUES (?, ?, ?)''', rows)
+    database.commit()
 
 
 def find_all_file_versions(mainline, branch, path):
+    # returns the raw history of a file on a branch, as (format, lines), and the version tuples it yields
+    start = time.time()
+    try:
+        historyFormat, lines = fetch_file_history(mainline, branch, path)
+        return historyFormat, lines, interpret_file_history(historyFormat, lines, branch, path)
+    finally:
+        # includes the sscm round trip.  the difference to "sscm history" is mostly spent parsing.
+        record_timing("find_all_file_versions", time.time() - start)
+
+
+def fetch_file_history(mainline, branch, path):
+    # fetches the history of one file on one branch, as (format, lines).  this is what the 'raw_history' table keeps,
+    # so that 'reparse' can interpret it again without the server.  the format is "cli" for the output of
+    # `sscm history` (minus its header), or "sscmhist" for the rows of the sscmhist helper, one per line.
     repo, file = os.path.split(path)
+    if historyBackend == "sscmhist":
+        rows = get_sscmhist_client(mainline).query(branch, repo, file)
+        # the helper doesn't report the source and target of renames and moves.  files that have been renamed or
+        # moved are rare, so for those the history is taken from `sscm history` instead.
+        if not any(actionMap.get(row[2]) == Actions.FILE_RENAME for row in rows if len(row) > 2):
+            return "sscmhist", ['\t'.join(row) for row in rows]
+
+    # the first 4 lines of `sscm history` are a header
+    return "cli", list(get_lines_from_sscm_cmd(["history", file, "-b" + branch, "-p" + repo], 4))
+
+
+def interpret_file_history(historyFormat, lines, branch, path):
+    # turns the lines of fetch_file_history() into version tuples
+    if historyFormat == "sscmhist":
+        return parse_native_history_lines(lines, branch, path)
+    return parse_history_lines(lines)
+
+
+def get_sscmhist_client(mainline):
+    # each parse worker (or the main thread, when running serially) gets its own helper
+    client = getattr(workerState, "sscmhist", None)
+    if client is None:
+        client = SscmhistClient(sscmhistCmd, mainline)
+        workerState.sscmhist = client
+        with workerLock:
+            sscmhistClients.append(client)
+    return client
+
 
-    cmd = 'sscm history "%s" -b"%s" -p"%s" | tail -n +5' % (file, branch, repo)
-    lines = get_lines_from_sscm_cmd(cmd)
+def close_sscmhist_clients():
+    with workerLock:
+        while sscmhistClients:
+            sscmhistClients.pop().close()
 
-    # this is complicated because the comment for a check-in will be on the line *following* a regex match
+
+def parse_native_history_lines(lines, branch, path):
+    # same version tuples as parse_history_lines(), but from the rows of the sscmhist helper (see fetch_file_history())
     versionList = []
-    comment = None
-    bFoundOne = False
+    for line in lines:
+        fields = line.split('\t')
+        if len(fields) != 7:
+            # e.g. an sscmhist built before it reported action names and comments
+            raise Exception("Unexpected output from the sscmhist helper for '%s' on branch '%s' (rebuild sscmhist/?): %s" % (path, branch, line))
+        version, date, action, actionBranch, actionVersion, username, comment = fields
+        if action not in actionMap:
+            sys.stderr.write("\n[*] Skipping unknown history action '%s' of '%s' on branch '%s'" % (action, path, branch))
+            continue
+        if action == "add to branch":
+            data = actionBranch
+        else:
+            data = None
+        versionList.append((int(date), action, None, int(version), username, unescape_sscmhist_field(comment) or None, data))
+    return versionList
+
+
+def unescape_sscmhist_field(text):
+    # undoes the escaping of backslashes, tabs and line breaks in the output of the sscmhist helper
+    return re.sub(r"\\(.)", lambda match: {"t": "\t", "n": "\n", "r": "\r"}.get(match.group(1), match.group(1)), text)
+
+
+def parse_history_lines(lines):
+    # single-pass parser for `sscm history` output (minus its header).
+    # this is complicated because the comment for a check-in will be on the line(s) *following* a regex match,
+    # and because a long version line may itself be wrapped over several lines.
+    # every line is either the start of a new version, or part of the comment of the previous version.  a line that
+    # doesn't match on its own may complete a wrapped version line, so it is also tried joined to the few lines before
+    # it.  that window is bounded by maxWrappedHistoryLines, which keeps the parser linear in the length of comments.
+    versionList = []
+    version = None
+    commentLines = []
     for line in lines:
         #sys.stderr.write("\n=== Trying line = " + line)
 
-        result = histRegex.search(line)
+        result = search_version_line(line)
         if result:
-            # we have a new match.
+            # we have a new match.  everything collected so far is the comment of the previous version.
             #sys.stderr.write("\n******* line match!")
-
-            if bFoundOne:
-                # before processing this match, we need to commit the previously found version
-                versionList.append((timestamp, action, origFile, int(version), author, comment, data))
-            # set bFoundOne once we've found our first version
-            bFoundOne = True
-            action = result.group("action")
-            origFile = result.group("from")
-            to = result.group("to")
-            author = result.group("author")
-            version = result.group("version")
-            timestamp = result.group("timestamp")
-            # reset comment
-            comment = None
-            if origFile and to:
-                # we're in a rename/move scenario
-                data = to
-            else:
-                # we're (possibly) in a branch scenario
-                data = result.group("data")
+            entryStart = len(commentLines)
         else:
-            # no match.  this must be a comment line (or the start of a new history line, with a line break).
-            #sys.stderr.write("\n------- no line match")
-
-            if not comment:
-                # start of comment
-                comment = re.sub("^ Comments \- ", "", line, count=1)
-            else:
-                # continuation of comment
-                comment += "\n" + line
-
-                # check for a multi-line comment that is actually a version match
-                commentLines = [real_line for real_line in comment.split('\n') if real_line]
-                substrings = []
-                # '-1' on following line is because we don't need to check the last comment line again.
-                # (we just checked it above.)
-                for i in range(len(commentLines) - 1):
-                    substrings.append('\n'.join(commentLines[i:len(commentLines)]))
-                for substring in substrings:
-                    #sys.stderr.write("\n----- Trying substring = " + substring)
-
-                    result = histRegex.search(substring)
-                    if result:
-                        # we have a new match
-
-                        # pull off end part of comment that we're recording as a version
-                        if i == 0:
-                            # using the entire comment
-                            comment = None
-                        else:
-                            # leaving behind the previous comment
-                            comment = '\n'.join(commentLines[0:i - 1])
-
-                        if bFoundOne:
-                            # before processing this match, we need to commit the previously found version
-                            versionList.append((timestamp, action, origFile, int(version), author, comment, data))
-                        # set bFoundOne once we've found our first version
-                        bFoundOne = True
-                        action = result.group("action")
-                        origFile = result.group("from")
-                        to = result.group("to")
-                        author = result.group("author")
-                        version = result.group("version")
-                        timestamp = result.group("timestamp")
-                        # reset comment
-                        comment = None
-                        if origFile and to:
-                            # we're in a rename/move scenario
-                            data = to
-                        else:
-                            # we're (possibly) in a branch scenario
-                            data = result.group("data")
-
-                        #sys.stderr.write("\n******* comment match! action = '" + str(action) + "' comment = '" + str(comment) + "'")
-                        break
+            # no match.  this must be a comment line (or the end of a version line, with a line break).
+            commentLines.append(line)
+            entryStart = None
+            for i in range(max(0, len(commentLines) - maxWrappedHistoryLines), len(commentLines) - 1):
+                candidate = '\n'.join(commentLines[i:])
+                result = search_version_line(candidate)
+                if result and result.end() == len(candidate):
+                    # pull off end part of comment that we're recording as a version
+                    entryStart = i + candidate.count('\n', 0, result.start())
+                    #sys.stderr.write("\n******* comment match!")
+                    break
+            if entryStart is None:
+                continue
+
+        if version:
+            # before processing this match, we need to commit the previously found version
+            versionList.append(finish_history_version(version, commentLines[:entryStart]))
+        version = result
+        commentLines = []
 
     # before moving on, we need to commit the last found version
-    if bFoundOne:
-        versionList.append((timestamp, action, origFile, int(version), author, comment, data))
+    if version:
+        versionList.append(finish_history_version(version, commentLines))
 
     #sys.stderr.write("\nreturning versionList = " + str(versionList))
 
     return versionList
 
 
-def create_database():
+def search_version_line(text):
+    if not histTailRegex.search(text):
+        return None
+    return histRegex.search(text)
+
+
+def finish_history_version(result, commentLines):
+    # builds a version tuple from a histRegex match and the comment lines that followed it
+    if commentLines:
+        comment = '\n'.join([re.sub(r"^ Comments \- ", "", commentLines[0], count=1)] + commentLines[1:])
+    else:
+        comment = None
+    origFile = result.group("from")
+    to = result.group("to")
+    if origFile and to:
+        # we're in a rename/move scenario
+        data = to
+    else:
+        # we're (possibly) in a branch scenario
+        data = result.group("data")
+    return (result.group("timestamp"), result.group("action"), origFile, int(result.group("version")), result.group("author"), comment, data)
+
+
+def create_database(fast=False):
     # database file is created in cwd
     name = datetime.datetime.fromtimestamp(time.time()).strftime('%Y%m%d%H%M%S') + '.db'
+    return open_database(name, fast)
+
+
+def is_parse_database(name):
+    # whether 'name' is the database of an earlier parse (complete or not), without creating it if it doesn't exist
+    if not os.path.isfile(name):
+        return False
     database = sqlite3.connect(name)
+    try:
+        return database.execute('''SELECT 1 FROM sqlite_master WHERE type='table' AND name=?''', ("parsed_files",)).fetchone() is not None
+    except sqlite3.DatabaseError:
+        # not a database at all
+        return False
+    finally:
+        database.close()
+
+
+def open_database(name, fast=False):
+    # opens (or creates) a database.  tables are only created if missing, so this is also used to resume.
+    database = sqlite3.connect(name)
+    if fast:
+        # trade durability for speed.  only suitable for throwaway databases, as a crash may corrupt the file.
+        database.execute('''PRAGMA journal_mode=WAL''')
+        database.execute('''PRAGMA synchronous=OFF''')
     c = database.cursor()
     # we intentionally avoid duplicates via the PRIMARY KEY
-    c.execute('''CREATE TABLE operations (timestamp INTEGER NOT NULL, action INTEGER NOT NULL, mainline TEXT NOT NULL, branch TEXT NOT NULL, path TEXT, origPath TEXT, version INTEGER, author TEXT, comment TEXT, data TEXT, PRIMARY KEY(action, mainline, branch, path, origPath, version, author, data))''')
+    c.execute('''CREATE TABLE IF NOT EXISTS operations (timestamp INTEGER NOT NULL, action INTEGER NOT NULL, mainline TEXT NOT NULL, branch TEXT NOT NULL, path TEXT, origPath TEXT, version INTEGER, author TEXT, comment TEXT, data TEXT, PRIMARY KEY(action, mainline, branch, path, origPath, version, author, data))''')
+    # branch catalog, so that both phases can look up branch properties without asking the server each time
+    c.execute('''CREATE TABLE IF NOT EXISTS branches (name TEXT NOT NULL PRIMARY KEY, type TEXT NOT NULL, parent TEXT)''')
+    # (branch, file) pairs listed by `sscm ls`, i.e. files that currently exist on a branch, and the version listed
+    c.execute('''CREATE TABLE IF NOT EXISTS files (branch TEXT NOT NULL, path TEXT NOT NULL, version INTEGER, PRIMARY KEY(branch, path))''')
+    if "version" not in [column[1] for column in c.execute('''PRAGMA table_info(files)''')]:
+        # databases from before the version was kept.  'sync' then compares with the history (see index_changed_files_in_branches())
+        c.execute('''ALTER TABLE files ADD COLUMN version INTEGER''')
+    # (branch, file) pairs whose history is to be parsed, by round (see cmd_parse), and position of the branch
+    c.execute('''CREATE TABLE IF NOT EXISTS queued_files (round INTEGER NOT NULL, position INTEGER NOT NULL, branch TEXT NOT NULL, path TEXT NOT NULL, PRIMARY KEY(branch, path))''')
+    c.execute('''CREATE INDEX IF NOT EXISTS queued_files_round ON queued_files (round, position, path)''')
+    # history of each (branch, file) pair as fetched (see fetch_file_history()), from which 'reparse' rebuilds 'operations'.
+    # 'sequence' is the order in which the parse first fetched the pairs, which 'reparse' follows.
+    c.execute('''CREATE TABLE IF NOT EXISTS raw_history (branch TEXT NOT NULL, path TEXT NOT NULL, format TEXT NOT NULL, history TEXT NOT NULL, sequence INTEGER, PRIMARY KEY(branch, path))''')
+    if "sequence" not in [column[1] for column in c.execute('''PRAGMA table_info(raw_history)''')]:
+        # databases from before the sequence was kept.  it is taken from the parse queue, as far as that still has the
+        # pairs (a 'sync' replaces it).  the rest follow, in the order they were stored.
+        c.execute('''ALTER TABLE raw_history ADD COLUMN sequence INTEGER''')
+        rowids = [row[0] for row in c.execute('''SELECT r.rowid FROM raw_history r LEFT JOIN queued_files q ON q.branch=r.branch AND q.path=r.path
+                                                 ORDER BY q.round IS NULL, q.round, q.position, q.path, r.rowid''')]
+        c.executemany('''UPDATE raw_history SET sequence=? WHERE rowid=?''', enumerate(rowids, 1))
+    c.execute('''CREATE INDEX IF NOT EXISTS raw_history_sequence ON raw_history (sequence)''')
+    # (branch, file) pairs whose history has been fully written.  this is what lets an interrupted parse resume.
+    c.execute('''CREATE TABLE IF NOT EXISTS parsed_files (branch TEXT NOT NULL, path TEXT NOT NULL, PRIMARY KEY(branch, path))''')
+    # state of the last export, so that a later 'sync' can continue where it left off
+    c.execute('''CREATE TABLE IF NOT EXISTS export_state (key TEXT NOT NULL PRIMARY KEY, value TEXT)''')
+    # the trees are versioned by 'generation', the mark at which a row was written.  a path deleted from a tree leaves a
+    # row without a mark.  this is what lets 'export --resume' restore the trees as of any checkpoint kept.
+    if c.execute('''SELECT 1 FROM sqlite_master WHERE type='table' AND name=?''', ("export_trees",)).fetchone() and \
+            "generation" not in [column[1] for column in c.execute('''PRAGMA table_info(export_trees)''')]:
+        # databases from before the trees were versioned.  what they hold predates any checkpoint.
+        c.execute('''ALTER TABLE export_trees RENAME TO export_trees_unversioned''')
+        c.execute('''CREATE TABLE export_trees (branch TEXT NOT NULL, path TEXT NOT NULL, generation INTEGER NOT NULL, mark INTEGER, PRIMARY KEY(branch, path, generation))''')
+        c.execute('''INSERT INTO export_trees SELECT branch, path, 0, mark FROM export_trees_unversioned''')
+        c.execute('''DROP TABLE export_trees_unversioned''')
+    c.execute('''CREATE TABLE IF NOT EXISTS export_trees (branch TEXT NOT NULL, path TEXT NOT NULL, generation INTEGER NOT NULL, mark INTEGER, PRIMARY KEY(branch, path, generation))''')
+    c.execute('''CREATE TABLE IF NOT EXISTS export_blobs (hash TEXT NOT NULL PRIMARY KEY, mark INTEGER NOT NULL)''')
+    c.execute('''CREATE TABLE IF NOT EXISTS export_files (branch TEXT NOT NULL, path TEXT NOT NULL, version INTEGER NOT NULL, mark INTEGER NOT NULL, PRIMARY KEY(branch, path, version))''')
+    # the rest of the state (see 'export_state') as of each checkpoint kept, while an export is underway
+    c.execute('''CREATE TABLE IF NOT EXISTS export_checkpoints (mark INTEGER NOT NULL PRIMARY KEY, state TEXT NOT NULL)''')
     database.commit()
     return database
 
 
-def add_record_to_database(record, database):
+# buffers records and writes them to the database in large transactions.
+# committing after every INSERT costs an fsync per history row, which dominates the parse phase on slow storage.
+class DatabaseWriter:
+    def __init__(self, database, transactionSize, nullSafe=False):
+        self.database = database
+        self.transactionSize = max(1, transactionSize)
+        # NULLs never collide in the PRIMARY KEY, so re-harvesting history (see 'sync') would duplicate rows.
+        # in null-safe mode, a record is skipped if an equal one already exists (ignoring the back-filled origPath).
+        self.nullSafe = nullSafe
+        self.pending = []
+        self.pendingFiles = []
+        self.pendingQueued = []
+        self.pendingHistory = []
+        self.pendingHistorySize = 0
+        self.nextSequence = None
+
+    def add(self, record):
+        self.pending.append(record.get_tuple())
+
+    def add_raw_history(self, branch, path, historyFormat, lines):
+        # the history as fetched, for 'reparse'.  a later fetch (see 'sync') replaces it, as it is complete, but keeps
+        # the pair's place in the sequence.
+        if self.nextSequence is None:
+            self.nextSequence = (self.database.execute('''SELECT MAX(sequence) FROM raw_history''').fetchone()[0] or 0) + 1
+        history = '\n'.join(lines)
+        self.pendingHistory.append((branch, path, historyFormat, history, branch, path, self.nextSequence))
+        self.pendingHistorySize = self.pendingHistorySize + len(history)
+        self.nextSequence = self.nextSequence + 1
+
+    def add_queued_files(self, rows):
+        # (round, position, branch, path) rows for later rounds.  pairs that were queued before are ignored.
+        self.pendingQueued.extend(rows)
+
+    def add_parsed_file(self, branch, path):
+        # marks the history of a file on a branch as complete.  transactions only end here, so a file's records are
+        # always committed together with this mark.  a resumed parse never sees half of a file's history.
+        # files count towards the transaction as well, since a 'sync' keeps few of their records.
+        self.pendingFiles.append((branch, path))
+        if len(self.pending) + len(self.pendingFiles) >= self.transactionSize or self.pendingHistorySize >= rawHistoryBufferSize:
+            self.flush()
+
+    def flush(self):
+        start = time.time()
+        count_stat("records written", len(self.pending))
+        count_stat("files parsed", len(self.pendingFiles))
+        if self.pending:
+            if self.nullSafe:
+                rows = [row + (row[0], row[1], row[2], row[3], row[4], row[6], row[7], row[9]) for row in self.pending]
+                self.database.executemany('''INSERT OR IGNORE INTO operations SELECT ?, ?, ?, ?, ?, ?, ?, ?, ?, ? WHERE NOT EXISTS
+                                               (SELECT 1 FROM operations WHERE timestamp=? AND action=? AND mainline=? AND branch=? AND path IS ? AND version IS ? AND author IS ? AND data IS ?)''', rows)
+            else:
+                # duplicates are dropped via the PRIMARY KEY.  as before, the first record inserted wins.
+                self.database.executemany('''INSERT OR IGNORE INTO operations VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)''', self.pending)
+            self.pending = []
+        if self.pendingFiles:
+            self.database.executemany('''INSERT OR IGNORE INTO parsed_files VALUES (?, ?)''', self.pendingFiles)
+            self.pendingFiles = []
+        if self.pendingHistory:
+            self.database.executemany('''INSERT OR REPLACE INTO raw_history SELECT ?, ?, ?, ?, COALESCE((SELECT sequence FROM raw_history WHERE branch=? AND path=?), ?)''', self.pendingHistory)
+            self.pendingHistory = []
+            self.pendingHistorySize = 0
+        if self.pendingQueued:
+            self.database.executemany('''INSERT OR IGNORE INTO queued_files VALUES (?, ?, ?, ?)''', self.pendingQueued)
+            self.pendingQueued = []
+        self.database.commit()
+        record_timing("database flush", time.time() - start)
+
+
+def create_database_indexes(database):
+    # indexes are created after the bulk load, since maintaining them during the load only slows it down.
+    # the first serves the export ordering, the second serves the rename back-fill.
     c = database.cursor()
-    try:
-        c.execute('''INSERT INTO operations VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)''', record.get_tuple())
-    except sqlite3.IntegrityError as e:
-        # TODO is there a better way to detect duplicates?  is sqlite3.IntegrityError too wide a net?
-        #sys.stderr.write("\nDetected duplicate record %s" % str(record.get_tuple()))
-        pass
+    c.execute('''CREATE INDEX IF NOT EXISTS operations_by_timestamp ON operations (timestamp)''')
+    c.execute('''CREATE INDEX IF NOT EXISTS operations_by_file ON operations (action, mainline, branch, path, version)''')
     database.commit()
 
-    if record.action == Actions.FILE_RENAME:
-        c.execute('''UPDATE operations SET origPath=? WHERE action=? AND mainline=? AND branch=? AND path=? AND (origPath IS NULL OR origPath='') AND version<=?''', (record.origPath, Actions.FILE_MODIFY, record.mainline, record.branch, record.path, record.version))
-        database.commit()
+
+def backfill_renamed_paths(database):
+    # a file modified before it was renamed must be committed under the name it had at the time.
+    # each FILE_MODIFY record without an origPath takes the origPath of the earliest rename of that file (on that
+    # branch) at or after its version.  this runs as one set-based pass once all records have been loaded.
+    c = database.cursor()
+    c.execute('''UPDATE operations SET origPath=(SELECT r.origPath FROM operations AS r WHERE r.action=? AND r.mainline=operations.mainline AND r.branch=operations.branch AND r.path=operations.path AND r.version>=operations.version ORDER BY r.version ASC LIMIT 1)
+                 WHERE action=? AND (origPath IS NULL OR origPath='') AND EXISTS (SELECT 1 FROM operations AS r WHERE r.action=? AND r.mainline=operations.mainline AND r.branch=operations.branch AND r.path=operations.path AND r.version>=operations.version)''',
+              (Actions.FILE_RENAME, Actions.FILE_MODIFY, Actions.FILE_RENAME))
+    database.commit()
 
 
-def cmd_parse(mainline, path, database):
+def find_all_records_for_file(mainline, branch, path, fullPathWalk):
+    # fetches the history of one file on one branch, and converts it into database records.  returns the raw history
+    # as well, as (format, lines, records).  this does not touch the database, so it is safe to call from a parse worker.
+    historyFormat, lines, versions = find_all_file_versions(mainline, branch, fullPathWalk)
+    #sys.stderr.write("\n[*] \t\tversions = %s" % versions)
+    return historyFormat, lines, build_records_for_file(mainline, branch, path, fullPathWalk, versions)
+
+
+def build_records_for_file(mainline, branch, path, fullPathWalk, versions):
+    # converts the version tuples of one file on one branch into database records.  this is where the mapping rules
+    # live, so it is shared by 'parse' and 'reparse'.
+    pathWalk, fileWalk = os.path.split(fullPathWalk)
+
+    records = []
+    for timestamp, action, origPath, version, author, comment, data in versions:
+        if isinstance(timestamp, int):
+            # the sscmhist backend already reports seconds since the epoch
+            epoch = timestamp
+        else:
+            epoch = int(time.mktime(time.strptime(timestamp, "%m/%d/%Y %I:%M %p")))
+        # branch operations don't follow the actionMap
+        if action == "add to branch":
+            if is_snapshot_branch(data, pathWalk):
+                branchAction = Actions.BRANCH_SNAPSHOT
+            else:
+                branchAction = Actions.BRANCH_BASELINE
+            records.append(DatabaseRecord((epoch, branchAction, mainline, branch, path, None, version, author, comment, data)))
+        else:
+            if origPath:
+                if action == "renamed":
+                    origFullPath = os.path.join(pathWalk, origPath)
+                    data = os.path.join(pathWalk, data)
+                elif action == "moved":
+                    origFullPath = os.path.join(origPath, fileWalk)
+                    data = os.path.join(data, fileWalk)
+            else:
+                origFullPath = None
+            records.append(DatabaseRecord((epoch, actionMap[action], mainline, branch, fullPathWalk, origFullPath, version, author, comment, data)))
+    return records
+
+
+def parse_worker(unit):
+    # runs on a parse worker thread.  fetches and interprets the history for a single (branch, file) pair.
+    global workerCount
+
+    index, total, mainline, branch, path, fullPathWalk = unit
+
+    if not hasattr(workerState, "number"):
+        with workerLock:
+            workerCount = workerCount + 1
+            workerState.number = workerCount
+            workerState.done = 0
+
+    result = find_all_records_for_file(mainline, branch, path, fullPathWalk)
+
+    workerState.done = workerState.done + 1
+    sys.stderr.write("\n[*] Worker %d (%d done): parsed file %d/%d '%s' on branch '%s'" % (workerState.number, workerState.done, index + 1, total, fullPathWalk, branch))
+    return result
+
+
+def count_queued_files(database, parseRound):
+    return database.execute('''SELECT COUNT(*) FROM queued_files q WHERE round=?
+                               AND NOT EXISTS (SELECT 1 FROM parsed_files p WHERE p.branch=q.branch AND p.path=q.path)''', (parseRound,)).fetchone()[0]
+
+
+def iterate_queued_files(database, parseRound, batchSize=1000):
+    # yields the (branch, file) pairs of a round that haven't been parsed yet, ordered by branch, then by file.
+    # rows are read in batches that continue after the last row of the previous one, so that no cursor stays open
+    # while the writer commits, and memory stays flat however many pairs there are.
+    lastPosition, lastPath = -1, ""
+    while True:
+        rows = database.execute('''SELECT position, branch, path FROM queued_files q WHERE round=? AND (position, path)>(?, ?)
+                                    AND NOT EXISTS (SELECT 1 FROM parsed_files p WHERE p.branch=q.branch AND p.path=q.path)
+                                    ORDER BY position, path LIMIT ?''', (parseRound, lastPosition, lastPath, batchSize)).fetchall()
+        if not rows:
+            break
+        for position, branch, fullPathWalk in rows:
+            yield branch, fullPathWalk
+        lastPosition, lastPath = rows[-1][0], rows[-1][2]
+
+
+def map_units(pool, worker, units, lookahead):
+    # yields (unit, result) in the order of 'units'.  with a pool, at most 'lookahead' units are in flight, as
+    # Pool.imap() would read all of them into its task queue up front.
+    if not pool:
+        for unit in units:
+            yield unit, worker(unit)
+        return
+    window = collections.deque()
+    for unit in units:
+        window.append((unit, pool.apply_async(worker, (unit,))))
+        if len(window) > lookahead:
+            unit, result = window.popleft()
+            yield unit, result.get()
+    while window:
+        unit, result = window.popleft()
+        yield unit, result.get()
+
+
+def cmd_parse(mainline, path, database, jobs=1, transactionSize=10000, since=None):
     sys.stderr.write("[+] Beginning parse phase...")
+    begin_stats_phase("parse")
+
+    # when 'since' is given, only operations from that time on are harvested (into an already populated database)
+    writer = DatabaseWriter(database, transactionSize, since is not None)
 
     branches = find_all_branches_in_mainline_containing_path(mainline, path)
 
-    # NOTE how we're passing branches, not branch.  this is to detect deleted files.
-    filesToWalk = find_all_files_in_branches_under_path(mainline, branches, path)
+    load_branch_catalog(database)
+    catalog_branches(branches, path, jobs)
+    save_branch_catalog(database)
+
+    # only (branch, file) pairs where the file is listed are queried up front.  this is instead of the product of all
+    # branches and all files, as most files only ever existed on a few branches (and `lsbranch` returns branches that
+    # don't include the path at all).  files deleted from a branch are found in later rounds, via find_related_pairs().
+    # the pairs are queued in the database rather than in memory, so that huge trees don't exhaust it.  the queue is
+    # kept between runs:  when resuming, every pair that a previous run already finished is skipped.
+    # a sync only starts from the pairs that have changed since the last parse (see index_changed_files_in_branches()).
+    branchOrder = dict((branch, index) for index, branch in enumerate(branches))
+    if since is None:
+        numListed = index_files_in_branches(database, branches, path)
+        numFiles = database.execute('''SELECT COUNT(DISTINCT path) FROM files''').fetchone()[0]
+        sys.stderr.write("\n[*] Found %d files on %d branches, in %d (branch, file) pairs (instead of %d)" % (numFiles, len(branches), numListed, numFiles * len(branches)))
+        numParsed = database.execute('''SELECT COUNT(*) FROM parsed_files''').fetchone()[0]
+        if numParsed:
+            sys.stderr.write("\n[*] Resuming parse, skipping %d already parsed files ..." % numParsed)
+        for branch, position in branchOrder.items():
+            database.execute('''INSERT OR IGNORE INTO queued_files SELECT 0, ?, branch, path FROM files WHERE branch=?''', (position, branch))
+        database.commit()
+    else:
+        listedBranches, newBranches = index_changed_files_in_branches(database, mainline, branches, branchOrder, path)
+        sys.stderr.write("\n[*] Found %d changed (branch, file) pairs" % count_queued_files(database, 0))
+    relatedBranches = find_related_branches(branches)
+    ancestorBranches = find_ancestor_branches(branches)
+
+    pool = None
+    if jobs > 1:
+        # history fetches are farmed out to a pool of workers, but this thread remains the only writer to the database.
+        # results are consumed in the same (branch, file) order as a serial run, so that duplicate detection via the
+        # PRIMARY KEY (and the rename back-fill) yield exactly the same 'operations' table.
+        pool = ThreadPool(jobs)
+    try:
+        parseRound = 0
+        while parseRound <= (database.execute('''SELECT MAX(round) FROM queued_files''').fetchone()[0] or 0):
+            total = count_queued_files(database, parseRound)
+            units = ((index, total, mainline, branch, path, fullPathWalk) for index, (branch, fullPathWalk) in enumerate(iterate_queued_files(database, parseRound)))
+            if pool:
+                sys.stderr.write("\n[*] Parsing %d (branch, file) pairs using %d workers ..." % (total, jobs))
+            else:
+                sys.stderr.write("\n[*] Parsing %d (branch, file) pairs ..." % total)
+
+            for unit, (historyFormat, lines, records) in map_units(pool, parse_worker, units, jobs * 4):
+                writer.add_raw_history(unit[3], unit[5], historyFormat, lines)
+                for record in records:
+                    if since is None or record.timestamp >= since:
+                        writer.add(record)
+                # queued in the same transaction as the parsed file, so that a resumed parse still finds them
+                if since is None:
+                    related = find_related_pairs(unit[3], unit[5], records, relatedBranches, ancestorBranches)
+                elif unit[3] in newBranches:
+                    # when syncing, the only unchanged pairs with new history are those of the parent of a new branch,
+                    # which records its creation.  a parent that is new itself was listed for the first round anyway.
+                    related = set((branch, unit[5]) for branch in ancestorBranches.get(unit[3], [])[:1])
+                else:
+                    related = ()
+                writer.add_queued_files((parseRound + 1, branchOrder[branch], branch, fullPathWalk) for branch, fullPathWalk in related)
+                writer.add_parsed_file(unit[3], unit[5])
+            writer.flush()
+            parseRound = parseRound + 1
+    except:
+        if pool:
+            pool.terminate()
+        raise
+    else:
+        if pool:
+            pool.close()
+    finally:
+        if pool:
+            pool.join()
+
+    writer.flush()
+    close_sscmhist_clients()
+    # also keep any branches we learned about along the way (e.g. deleted branches)
+    save_branch_catalog(database)
+    if since is not None:
+        save_changed_files(database, listedBranches)
+
+    sys.stderr.write("\n[*] Indexing database ...")
+    create_database_indexes(database)
+
+    sys.stderr.write("\n[*] Back-filling original paths of renamed files ...")
+    backfill_renamed_paths(database)
+
+    end_stats_phase()
+    sys.stderr.write("\n[+] Parse phase complete")
 
-    for branch in branches:
-        sys.stderr.write("\n[*] Parsing branch '%s' ..." % branch)
 
-        for fullPathWalk in filesToWalk:
-            #sys.stderr.write("\n[*] \tParsing file '%s' ..." % fullPathWalk)
+def init_reparse_worker(catalog):
+    # worker processes don't necessarily inherit our globals (e.g. when they are spawned), so the catalog is handed over
+    branchCatalog.update(catalog)
 
-            pathWalk, fileWalk = os.path.split(fullPathWalk)
 
-            versions = find_all_file_versions(mainline, branch, fullPathWalk)
-            #sys.stderr.write("\n[*] \t\tversions = %s" % versions)
+def reparse_worker(rows):
+    # runs in a reparse worker process.  interprets the stored history of a batch of (branch, file) pairs, and returns
+    # the records of each as tuples.  the server is not asked (except about branches missing from the catalog).
+    results = []
+    for mainline, path, branch, fullPathWalk, historyFormat, history in rows:
+        lines = history.split('\n') if history else []
+        versions = interpret_file_history(historyFormat, lines, branch, fullPathWalk)
+        results.append([record.get_tuple() for record in build_records_for_file(mainline, branch, path, fullPathWalk, versions)])
+    return results
 
-            for timestamp, action, origPath, version, author, comment, data in versions:
-                epoch = int(time.mktime(time.strptime(timestamp, "%m/%d/%Y %I:%M %p")))
-                # branch operations don't follow the actionMap
-                if action == "add to branch":
-                    if is_snapshot_branch(data, pathWalk):
-                        branchAction = Actions.BRANCH_SNAPSHOT
-                    else:
-                        branchAction = Actions.BRANCH_BASELINE
-                    add_record_to_database(DatabaseRecord((epoch, branchAction, mainline, branch, path, None, version, author, comment, data)), database)
-                else:
-                    if origPath:
-                        if action == "renamed":
-                            origFullPath = os.path.join(pathWalk, origPath)
-                            data = os.path.join(pathWalk, data)
-                        elif action == "moved":
-                            origFullPath = os.path.join(origPath, fileWalk)
-                            data = os.path.join(data, fileWalk)
-                    else:
-                        origFullPath = None
-                    add_record_to_database(DatabaseRecord((epoch, actionMap[action], mainline, branch, fullPathWalk, origFullPath, version, author, comment, data)), database)
 
-    sys.stderr.write("\n[+] Parse phase complete")
+def iterate_raw_history(database, mainline, path, batchSize=100):
+    # yields batches of stored history, in the order the parse fetched it.  the order matters:  of duplicate records,
+    # the first one inserted wins, and ties in the export order are broken by rowid.
+    # NOTE the order comes from raw_history itself.  the parse queue only holds the pairs of the last parse or 'sync'.
+    c = database.cursor()
+    c.execute('''SELECT ?, ?, branch, path, format, history FROM raw_history INDEXED BY raw_history_sequence ORDER BY sequence''', (mainline, path))
+    while True:
+        rows = c.fetchmany(batchSize)
+        if not rows:
+            break
+        yield rows
+
+
+def cmd_reparse(mainline, path, database, jobs=1, transactionSize=10000):
+    # rebuilds the 'operations' table from the history stored by an earlier parse, without asking the server.
+    # this is for iterating on how history is interpreted (e.g. actionMap), which would otherwise need a new parse.
+    sys.stderr.write("[+] Beginning reparse phase...")
+    begin_stats_phase("reparse")
+
+    total = database.execute('''SELECT COUNT(*) FROM raw_history''').fetchone()[0]
+    if not total:
+        raise Exception("No stored history found in database.  Run a parse first.")
+    load_branch_catalog(database)
+
+    # start from scratch.  as during the parse, indexes are only created after the bulk load.
+    database.execute('''DROP INDEX IF EXISTS operations_by_timestamp''')
+    database.execute('''DROP INDEX IF EXISTS operations_by_file''')
+    database.execute('''DELETE FROM operations''')
+    # the rows are renumbered, so an earlier export can't be continued by 'sync' anymore
+    for table in ("export_state", "export_trees", "export_blobs", "export_files"):
+        database.execute('''DELETE FROM %s''' % table)
+    database.commit()
+    writer = DatabaseWriter(database, transactionSize)
+
+    pool = None
+    if jobs > 1:
+        # interpreting history is CPU bound, so this uses processes rather than threads.  as in the parse, this
+        # process remains the only writer to the database, and consumes the results in order.
+        pool = multiprocessing.Pool(jobs, init_reparse_worker, (dict(branchCatalog),))
+        sys.stderr.write("\n[*] Reparsing %d (branch, file) pairs using %d processes ..." % (total, jobs))
+    else:
+        sys.stderr.write("\n[*] Reparsing %d (branch, file) pairs ..." % total)
+    try:
+        count = 0
+        for rows, results in map_units(pool, reparse_worker, iterate_raw_history(database, mainline, path), jobs * 2):
+            for row, records in zip(rows, results):
+                for record in records:
+                    writer.add(DatabaseRecord(record))
+                writer.add_parsed_file(row[2], row[3])
+            count = count + len(rows)
+            sys.stderr.write("\n[*] Reparsed %d/%d files" % (count, total))
+    except:
+        if pool:
+            pool.terminate()
+        raise
+    else:
+        if pool:
+            pool.close()
+    finally:
+        if pool:
+            pool.join()
+
+    writer.flush()
+    if count != total:
+        raise Exception("Reparsed only %d of the %d stored (branch, file) pairs." % (count, total))
+
+    sys.stderr.write("\n[*] Indexing database ...")
+    create_database_indexes(database)
+
+    sys.stderr.write("\n[*] Back-filling original paths of renamed files ...")
+    backfill_renamed_paths(database)
+
+    end_stats_phase()
+    sys.stderr.write("\n[+] Reparse phase complete")
 
 
 # Surround has different naming rules for branches than Git does for branches/tags.
@@ -415,166 +1263,960 @@ def translate_branch_name(name):
     return name
 
 
-# this is the function that prints most file data to the stream
-def print_blob_for_file(branch, fullPath, version=None):
-    global mark
-
+def hash_file(localPath):
+    digest = hashlib.sha1()
+    with open(localPath, "rb") as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+# on-disk, content-addressed store of file versions fetched from Surround, so that re-exporting an already harvested
+# repository reads from local disk instead of the server.  objects are kept under 'objects/' by the SHA-1 of their
+# content, and an SQLite index maps (mainline, branch, path, version) --> SHA-1, so that a store can be shared by the
+# exports of several mainlines.  the newest version of a file on a snapshot never changes, so it is kept as version 0.
+# when the objects exceed 'maxSize' bytes, the least recently used ones are evicted.  safe to use from several threads
+# (the prefetch workers).
+class BlobStore:
+    def __init__(self, directory, maxSize):
+        self.directory = directory
+        self.maxSize = maxSize
+        self.lock = threading.Lock()
+        self.objectsDir = os.path.join(directory, "objects")
+        if not os.path.isdir(self.objectsDir):
+            os.makedirs(self.objectsDir)
+        self.database = sqlite3.connect(os.path.join(directory, "index.db"), check_same_thread=False, timeout=60)
+        # the store is only a cache, so a lost update after a crash costs a download at worst
+        self.database.execute('''PRAGMA journal_mode=WAL''')
+        self.database.execute('''PRAGMA synchronous=NORMAL''')
+        self.database.execute('''CREATE TABLE IF NOT EXISTS objects (hash TEXT NOT NULL PRIMARY KEY, size INTEGER NOT NULL, used REAL NOT NULL)''')
+        self.database.execute('''CREATE INDEX IF NOT EXISTS objects_used ON objects (used)''')
+        if self.database.execute('''SELECT 1 FROM sqlite_master WHERE type='table' AND name=?''', ("versions",)).fetchone() and \
+                "mainline" not in [row[1] for row in self.database.execute('''PRAGMA table_info(versions)''')]:
+            # written by an older version, which didn't tell mainlines apart.  there's no telling which mainline
+            # those versions belong to, so they are forgotten.  the objects are left for eviction to remove.
+            self.database.execute('''DROP TABLE versions''')
+        self.database.execute('''CREATE TABLE IF NOT EXISTS versions (mainline TEXT NOT NULL, branch TEXT NOT NULL, path TEXT NOT NULL, version INTEGER NOT NULL, hash TEXT NOT NULL, PRIMARY KEY(mainline, branch, path, version))''')
+        self.database.execute('''CREATE INDEX IF NOT EXISTS versions_hash ON versions (hash)''')
+        self.database.commit()
+        self.size = self.database.execute('''SELECT COALESCE(SUM(size), 0) FROM objects''').fetchone()[0]
+
+    def object_path(self, digest):
+        return os.path.join(self.objectsDir, digest[:2], digest[2:])
+
+    def get(self, mainline, branch, fullPath, version, localPath):
+        # places the stored content of a file version at 'localPath', and returns whether it was found
+        with self.lock:
+            row = self.database.execute('''SELECT hash FROM versions WHERE mainline=? AND branch=? AND path=? AND version=?''', (mainline, branch, fullPath, version)).fetchone()
+            if not row:
+                return False
+            objectPath = self.object_path(row[0])
+            if not os.path.isfile(objectPath):
+                # removed behind our back
+                sizeRow = self.database.execute('''SELECT size FROM objects WHERE hash=?''', row).fetchone()
+                if sizeRow:
+                    self.size = self.size - sizeRow[0]
+                self.database.execute('''DELETE FROM versions WHERE hash=?''', row)
+                self.database.execute('''DELETE FROM objects WHERE hash=?''', row)
+                self.database.commit()
+                return False
+            self.database.execute('''UPDATE objects SET used=? WHERE hash=?''', (time.time(), row[0]))
+            self.database.commit()
+            try:
+                # a hard link is free, and the caller removing it doesn't affect the store
+                os.link(objectPath, localPath)
+            except OSError:
+                shutil.copyfile(objectPath, localPath)
+        return True
+
+    def has_branch(self, mainline, branch):
+        with self.lock:
+            return self.database.execute('''SELECT 1 FROM versions WHERE mainline=? AND branch=? LIMIT 1''', (mainline, branch)).fetchone() is not None
+
+    def put(self, mainline, branch, fullPath, version, localPath):
+        # adds a freshly fetched file version to the store
+        size = os.path.getsize(localPath)
+        if size > self.maxSize:
+            return
+        digest = hash_file(localPath)
+        objectPath = self.object_path(digest)
+        with self.lock:
+            if not os.path.isfile(objectPath):
+                if not os.path.isdir(os.path.dirname(objectPath)):
+                    os.makedirs(os.path.dirname(objectPath))
+                # written under a temporary name first, so that a reader never sees a partial object
+                fd, tempPath = tempfile.mkstemp(dir=self.objectsDir)
+                os.close(fd)
+                shutil.copyfile(localPath, tempPath)
+                os.rename(tempPath, objectPath)
+            if self.database.execute('''SELECT 1 FROM objects WHERE hash=?''', (digest,)).fetchone():
+                self.database.execute('''UPDATE objects SET used=? WHERE hash=?''', (time.time(), digest))
+            else:
+                self.database.execute('''INSERT INTO objects VALUES (?, ?, ?)''', (digest, size, time.time()))
+                self.size = self.size + size
+            self.database.execute('''INSERT OR REPLACE INTO versions VALUES (?, ?, ?, ?, ?)''', (mainline, branch, fullPath, version, digest))
+            self.evict()
+            self.database.commit()
+
+    def evict(self):
+        # removes the least recently used objects (and every version that refers to them) until the store fits
+        while self.size > self.maxSize:
+            rows = self.database.execute('''SELECT hash, size FROM objects ORDER BY used LIMIT 100''').fetchall()
+            if not rows:
+                break
+            for digest, size in rows:
+                try:
+                    os.remove(self.object_path(digest))
+                except OSError:
+                    pass
+                self.database.execute('''DELETE FROM versions WHERE hash=?''', (digest,))
+                self.database.execute('''DELETE FROM objects WHERE hash=?''', (digest,))
+                self.size = self.size - size
+                count_stat("blob store evictions")
+                if self.size <= self.maxSize:
+                    break
+
+    def close(self):
+        with self.lock:
+            self.database.commit()
+            self.database.close()
+
+
+def find_blob_mark(branch, fullPath, version):
+    # returns the mark of a blob already emitted for this file version (on this branch or inherited from its lineage)
+    if not version:
+        # newest version.  we can't know what that is without fetching it.
+        return None
+    key = (branch, fullPath, version)
+    if key in blobMarkDict:
+        return blobMarkDict[key]
+    if branch in branchBaseDict:
+        # walk up the branch lineage
+        parentBranch, inheritedVersions = branchBaseDict[branch]
+        inheritedVersion = inheritedVersions.get(fullPath)
+        if inheritedVersion and version <= inheritedVersion:
+            return find_blob_mark(parentBranch, fullPath, version)
+    return None
+
+
+def fetch_file(mainline, branch, fullPath, version=None, destDir=None):
+    # fetches a single file into 'destDir' (the scratch directory by default), and returns its local path.
+    # 'mainline' only serves to tell the versions in the blob store apart.
+    if not destDir:
+        destDir = scratchDir
     path, file = os.path.split(fullPath)
-    localPath = os.path.join(scratchDir, file)
+    localPath = os.path.join(destDir, file)
     if os.path.isfile(localPath):
         os.remove(localPath)
+
+    storeVersion = None
+    if blobStore:
+        # only versions that can't change are stored:  numbered ones, and the newest one on a snapshot
+        if version:
+            storeVersion = version
+        elif is_snapshot_branch(branch, path):
+            storeVersion = 0
+        if storeVersion is not None and not os.path.isdir(destDir):
+            # normally created by `sscm get`
+            os.makedirs(destDir)
+        if storeVersion is not None and blobStore.get(mainline, branch, fullPath, storeVersion, localPath):
+            count_stat("blob store hits")
+            return localPath
+
+    args = ["get", file, "-b" + branch, "-p" + path, "-d" + destDir, "-f", "-i"]
     if version:
-        # get specified version
-        cmd = 'sscm get "%s" -b"%s" -p"%s" -d"%s" -f -i -v%d' % (file, branch, path, scratchDir, version)
-    else:
-        # get newest version
-        cmd = 'sscm get "%s" -b"%s" -p"%s" -d"%s" -f -i' % (file, branch, path, scratchDir)
-    with open(os.devnull, 'w') as fnull:
-        subprocess.Popen(cmd, shell=True, stdout=fnull, stderr=fnull).communicate()
+        # get specified version (otherwise the newest version)
+        args.append("-v%d" % version)
+    run_sscm_cmd(args)
+    if os.path.isfile(localPath):
+        count_stat("bytes fetched", os.path.getsize(localPath))
+        if storeVersion is not None:
+            blobStore.put(mainline, branch, fullPath, storeVersion, localPath)
+    return localPath
+
+
+def fetch_tree(branch, path):
+    # fetches the newest version of every file under 'path' with a single recursive `sscm get`.
+    # each call gets its own staging directory, which the caller is responsible for removing.
+    if not os.path.isdir(scratchDir):
+        os.makedirs(scratchDir)
+    stagingDir = tempfile.mkdtemp(prefix="tree-", dir=scratchDir)
+    run_sscm_cmd(["get", "/", "-b" + branch, "-p" + path, "-d" + stagingDir, "-r", "-f", "-i"])
+    return stagingDir
+
+
+def prefetch_file(mainline, branch, fullPath, version):
+    # runs on a prefetch worker.  every request gets its own directory, so that concurrent fetches of files sharing
+    # a basename can't clobber each other.  the directory is removed once the blob has been printed.
+    stagingDir = tempfile.mkdtemp(prefix="file-", dir=scratchDir)
+    return fetch_file(mainline, branch, fullPath, version, stagingDir)
+
+
+def prefetch_blobs(records, lookahead, jobs):
+    # look-ahead stage between the database cursor and the stream writer.
+    # keeps up to 'lookahead' records in flight, fetching the blobs of FILE_MODIFY records on a pool of workers.
+    # yields (record, pending fetch or None) in the original order, so the emitted stream is unchanged.
+    if not os.path.isdir(scratchDir):
+        os.makedirs(scratchDir)
+
+    pool = ThreadPool(jobs)
+    window = collections.deque()
+    try:
+        for record in records:
+            prefetched = None
+            if record.action == Actions.FILE_MODIFY and not find_blob_mark(record.branch, record.path, record.version):
+                prefetched = pool.apply_async(prefetch_file, (record.mainline, record.branch, record.path, record.version))
+            window.append((record, prefetched))
+            if len(window) > lookahead:
+                yield window.popleft()
+        while window:
+            yield window.popleft()
+    finally:
+        pool.terminate()
+        pool.join()
+
+
+def find_all_files_in_tree(stagingDir, path):
+    # yields (Surround path, local path) for every file in a tree fetched by fetch_tree()
+    for root, dirs, files in os.walk(stagingDir):
+        dirs.sort()
+        for file in sorted(files):
+            localPath = os.path.join(root, file)
+            relativePath = os.path.relpath(localPath, stagingDir).replace(os.sep, "/")
+            yield "%s/%s" % (path, relativePath), localPath
+
+
+def print_blob(localPath):
+    # prints the contents of a local file as a blob, unless identical content was already emitted.
+    # either way, returns the mark holding the content.
+    global mark
+
+    digest = hash_file(localPath)
+    if digest in blobHashDict:
+        # identical content was already emitted (perhaps for another file, branch, or snapshot)
+        count_stat("blobs deduplicated")
+        return blobHashDict[digest]
+
+    size = os.path.getsize(localPath)
+    if lfsThreshold is not None and size > lfsThreshold:
+        blobHashDict[digest] = print_lfs_pointer(localPath, size)
+        dirtyBlobHashes.append(digest)
+        return blobHashDict[digest]
 
     mark = mark + 1
-    print("blob")
-    print("mark :%d" % mark)
-    print("data %d" % os.path.getsize(localPath))
+    stream.command("blob")
+    stream.command("mark :%d" % mark)
+    stream.data_from_file(localPath, size)
+    count_stat("blobs emitted")
+    count_stat("blob bytes emitted", size)
+    blobHashDict[digest] = mark
+    dirtyBlobHashes.append(digest)
+    return mark
+
+
+def lfs_objects_dir():
+    # where Git LFS keeps its local objects.  the export runs inside the repository that fast-import writes to.
+    return os.path.join(os.environ.get("GIT_DIR", ".git"), "lfs", "objects")
+
+
+def print_lfs_pointer(localPath, size):
+    # stores a file in the local Git LFS object store, and prints a pointer to it as the blob instead of the file.
+    # no LFS server is involved.  `git lfs` finds the objects locally, and they can be pushed to a server later.
+    global mark
+
+    digest = hashlib.sha256()
     with open(localPath, "rb") as f:
-        print(f.read())
+        for chunk in iter(lambda: f.read(blobChunkSize), b""):
+            digest.update(chunk)
+    oid = digest.hexdigest()
+    objectPath = os.path.join(lfs_objects_dir(), oid[0:2], oid[2:4], oid)
+    if not os.path.isfile(objectPath):
+        if not os.path.isdir(os.path.dirname(objectPath)):
+            os.makedirs(os.path.dirname(objectPath))
+        # written under a temporary name first, so that a partial object is never mistaken for a complete one
+        tempPath = objectPath + ".tmp"
+        try:
+            os.link(localPath, tempPath)
+        except OSError:
+            shutil.copyfile(localPath, tempPath)
+        os.rename(tempPath, objectPath)
+        count_stat("lfs objects stored")
+        count_stat("lfs bytes stored", size)
+
+    pointer = lfs_pointer(oid, size)
+    mark = mark + 1
+    stream.command("blob")
+    stream.command("mark :%d" % mark)
+    stream.data(pointer)
+    count_stat("lfs pointers emitted")
+    lfsMarkSet.add(mark)
     return mark
 
 
-def process_database_record(record):
+def lfs_pointer(oid, size):
+    return "version https://git-lfs.github.com/spec/v1\noid sha256:%s\nsize %d\n" % (oid, size)
+
+
+def print_lfs_attributes(paths):
+    # rewrites .gitattributes in the commit being written, so that exactly 'paths' are handled by Git LFS.
+    # the file is not part of branchTreeDict, which mirrors Surround.
+    if not paths:
+        stream.command("D .gitattributes")
+        return
+    lines = []
+    for path in sorted(paths):
+        # escaped like `git lfs track` does:  wildcards with a backslash, whitespace as a character class
+        pattern = re.sub(r"([\\*?\[])", r"\\\1", path).replace(" ", "[[:space:]]")
+        lines.append("/%s filter=lfs diff=lfs merge=lfs -text\n" % pattern)
+    stream.command("M 100644 inline .gitattributes")
+    stream.data(''.join(lines))
+
+
+# writer for the fast-import stream.  commands are encoded as UTF-8 into a large binary buffer, which is only written
+# out when it is full, before the raw contents of a file, and at explicit flush points (e.g. checkpoints), instead of
+# on every line.  'data' is always counted in bytes, so non-ASCII comments can't throw fast-import off.
+class StreamWriter:
+    def __init__(self, output, bufferSize):
+        self.output = output
+        self.bufferSize = bufferSize
+        self.buffer = bytearray()
+        # length of the stream so far, including what is still buffered
+        self.bytesWritten = 0
+
+    def command(self, line):
+        line = line.encode("utf-8")
+        self.buffer.extend(line)
+        self.buffer.extend(b"\n")
+        self.bytesWritten = self.bytesWritten + len(line) + 1
+        if len(self.buffer) >= self.bufferSize:
+            self.flush()
+
+    def data(self, content):
+        # a 'data' command with its content (text or bytes).  fast-import allows an optional LF after the content.
+        if not isinstance(content, bytes):
+            content = content.encode("utf-8")
+        self.command("data %d" % len(content))
+        if content:
+            self.buffer.extend(content)
+            self.bytesWritten = self.bytesWritten + len(content)
+            self.command("")
+
+    def data_from_file(self, localPath, size):
+        # a 'data' command with the contents of a local file, copied as raw bytes without ever holding more than a
+        # chunk of it in memory.  when the output is a pipe (the usual `| git fast-import`), the kernel copies the
+        # data via sendfile().
+        self.command("data %d" % size)
+        # anything buffered so far must hit the stream before the raw bytes do
+        self.flush()
+        start = time.time()
+        with open(localPath, "rb") as f:
+            offset = 0
+            if hasattr(os, "sendfile"):
+                try:
+                    outFd = self.output.fileno()
+                    if stat.S_ISFIFO(os.fstat(outFd).st_mode):
+                        while offset < size:
+                            sent = os.sendfile(outFd, f.fileno(), offset, size - offset)
+                            if sent == 0:
+                                break
+                            offset = offset + sent
+                except (OSError, AttributeError, io.UnsupportedOperation):
+                    # fall back to copying through userspace, from wherever sendfile() left off
+                    pass
+            f.seek(offset)
+            while offset < size:
+                chunk = f.read(min(blobChunkSize, size - offset))
+                if not chunk:
+                    break
+                self.output.write(chunk)
+                offset = offset + len(chunk)
+        self.bytesWritten = self.bytesWritten + offset
+        # mostly time spent waiting for `git fast-import` to drain the pipe
+        record_timing("stream write", time.time() - start)
+
+        if offset != size:
+            raise Exception("File '%s' changed size while being copied to the stream." % localPath)
+        self.command("")
+
+    def flush(self):
+        start = time.time()
+        if self.buffer:
+            self.output.write(self.buffer)
+            self.buffer = bytearray()
+        self.output.flush()
+        record_timing("stream write", time.time() - start)
+
+
+# this is the function that prints most file data to the stream
+def print_blob_for_file(mainline, branch, fullPath, version=None, prefetched=None):
+    start = time.time()
+    try:
+        return print_blob_for_file_version(mainline, branch, fullPath, version, prefetched)
+    finally:
+        record_timing("print_blob_for_file", time.time() - start)
+
+
+def print_blob_for_file_version(mainline, branch, fullPath, version, prefetched):
+    blobMark = find_blob_mark(branch, fullPath, version)
+    if blobMark:
+        # already emitted.  no need to fetch it again.
+        if prefetched:
+            shutil.rmtree(os.path.dirname(prefetched.get()), ignore_errors=True)
+        return blobMark
+
+    if prefetched:
+        localPath = prefetched.get()
+        try:
+            blobMark = print_blob(localPath)
+        finally:
+            shutil.rmtree(os.path.dirname(localPath), ignore_errors=True)
+    else:
+        blobMark = print_blob(fetch_file(mainline, branch, fullPath, version))
+
+    if version:
+        blobMarkDict[(branch, fullPath, version)] = blobMark
+        dirtyBlobMarks.append((branch, fullPath, version))
+    return blobMark
+
+
+def replace_branch_tree(branch, tree):
+    # replaces our view of a branch (see branchTreeDict), and notes the paths whose entry changed (see dirtyTreeDict)
+    oldTree = branchTreeDict.get(branch, {})
+    dirtyTreeDict.setdefault(branch, set()).update(path for path in set(oldTree) | set(tree) if oldTree.get(path) != tree.get(path))
+    branchTreeDict[branch] = tree
+
+
+def process_database_record(record, prefetched=None):
     global mark
 
     if record.action == Actions.BRANCH_SNAPSHOT:
+        if (record.data, record.path) in sessionSnapshotSet:
+            # every file in a snapshot reports it, but snapshots never change.  once is enough.
+            return
+        sessionSnapshotSet.add((record.data, record.path))
+
         # the basic idea here is to use a "TAG_FIXUP" branch, as recommended in the manpage for git-fast-import.
         # this is necessary since Surround version-controls individual files, and Git controls the state of the entire branch.
         # the purpose of this commit it to bring the branch state to match the snapshot exactly.
 
-        print("reset TAG_FIXUP")
-        print("from refs/heads/%s" % translate_branch_name(record.branch))
-
-        # get all files contained within snapshot
-        files = find_all_files_in_branches_under_path(record.mainline, [record.data], record.path)
-        startMark = None
-        for file in files:
-            blobMark = print_blob_for_file(record.data, file)
-            if not startMark:
-                # keep track of what mark represents the start of this snapshot data
-                startMark = blobMark
-
-        mark = mark + 1
-        print("commit TAG_FIXUP")
-        print("mark :%d" % mark)
-        # we don't have the legit email addresses, so we just use the author as the email address
-        print("author %s <%s> %s %s" % (record.author, record.author, record.timestamp, timezone))
-        print("committer %s <%s> %s %s" % (record.author, record.author, record.timestamp, timezone))
-        if record.comment:
-            print("data %d" % len(record.comment))
-            print(record.comment)
+        # get all files contained within snapshot.
+        # keep track of which mark holds the data for each file.
+        # blobs are deduplicated, so these are not necessarily consecutive (or even new).
+        snapshotTree = {}
+        if bulkFetch and not (blobStore and blobStore.has_branch(record.mainline, record.data)):
+            stagingDir = fetch_tree(record.data, record.path)
+            try:
+                for file, localPath in find_all_files_in_tree(stagingDir, record.path):
+                    if blobStore:
+                        # next time, the files are read from the store one by one
+                        blobStore.put(record.mainline, record.data, file, 0, localPath)
+                    snapshotTree[file] = print_blob(localPath)
+            finally:
+                shutil.rmtree(stagingDir, ignore_errors=True)
         else:
-            print("data 0")
-
-        # 'deleteall' tells Git to forget about previous branch state
-        print("deleteall")
-        # replay branch state from above-recorded marks
-        iterMark = startMark
-        for file in files:
-            print("M 100644 :%d %s" % (iterMark, file))
-            iterMark = iterMark + 1
-        if iterMark != mark:
-            raise Exception("Marks fell out of sync while tagging '%s'." % record.data)
-
-        # finally, tag our result
-        print("tag %s" % translate_branch_name(record.data))
-        print("from TAG_FIXUP")
-        print("tagger %s <%s> %s %s" % (record.author, record.author, record.timestamp, timezone))
-        if record.comment:
-            print("data %d" % len(record.comment))
-            print(record.comment)
+            for file in find_all_files_in_snapshot(record.data, record.path):
+                snapshotTree[file] = print_blob_for_file(record.mainline, record.data, file)
+
+        if record.data in branchTreeDict and translate_branch_name(record.data) in tagDict:
+            # the snapshot has already been tagged, e.g. for another path (see 'export' with several shards), or for
+            # another file version.  build upon it rather than on the parent branch, so nothing is lost.
+            parentTree = branchTreeDict[record.data]
+            parentHead = branchHeadDict.get(record.data)
+            parentLfsPaths = branchLfsDict.get(record.data, set())
         else:
-            print("data 0")
-
-        # save off the mapping between the tag name and the tag mark
-        tagDict[translate_branch_name(record.data)] = mark
+            parentTree = branchTreeDict.get(record.branch)
+            parentHead = branchHeadDict.get(record.branch)
+            parentLfsPaths = branchLfsDict.get(record.branch, set())
+        if parentTree is not None:
+            # we know exactly what the parent branch looks like, so the fixup only needs the differences.
+            # identical content always maps to the same mark, so comparing marks is comparing content.
+            # only files under the snapshot's path are considered.  anything else is kept as it is.
+            modified = sorted(file for file, blobMark in snapshotTree.items() if parentTree.get(file) != blobMark)
+            deleted = sorted(file for file in parentTree if file not in snapshotTree and file.startswith(record.path + '/'))
+            tree = dict(parentTree)
+            for file in deleted:
+                del tree[file]
+            tree.update(snapshotTree)
+        else:
+            modified = None
+            deleted = None
+            tree = snapshotTree
+        lfsPaths = set()
+        if lfsMarkSet:
+            lfsPaths = set(file for file, blobMark in tree.items() if blobMark in lfsMarkSet)
+
+        if parentHead and modified == [] and deleted == []:
+            # snapshot matches its parent exactly.  no fixup commit needed, just tag the parent's head.
+            tagMark = parentHead
+        else:
+            stream.command("reset TAG_FIXUP")
+            if parentHead:
+                stream.command("from :%d" % parentHead)
+            else:
+                stream.command("from refs/heads/%s" % translate_branch_name(record.branch))
+
+            mark = mark + 1
+            stream.command("commit TAG_FIXUP")
+            stream.command("mark :%d" % mark)
+            # we don't have the legit email addresses, so we just use the author as the email address
+            stream.command("author %s <%s> %s %s" % (record.author, record.author, record.timestamp, timezone))
+            stream.command("committer %s <%s> %s %s" % (record.author, record.author, record.timestamp, timezone))
+            stream.data(record.comment or "")
+
+            if modified is None:
+                # parent state is unknown.  'deleteall' tells Git to forget about previous branch state
+                stream.command("deleteall")
+                # replay branch state from above-recorded marks
+                for file in sorted(snapshotTree):
+                    stream.command("M 100644 :%d %s" % (snapshotTree[file], file))
+                if lfsPaths:
+                    print_lfs_attributes(lfsPaths)
+            else:
+                for file in deleted:
+                    stream.command("D %s" % file)
+                for file in modified:
+                    stream.command("M 100644 :%d %s" % (snapshotTree[file], file))
+                if lfsPaths != parentLfsPaths:
+                    print_lfs_attributes(lfsPaths)
+
+            tagMark = mark
+
+        # finally, tag our result (see print_snapshot_tags()).  save off the mapping between the tag name and the tag mark
+        if translate_branch_name(record.data) not in snapshotTagDict:
+            snapshotTagDict[translate_branch_name(record.data)] = (record.author, record.timestamp, record.comment)
+        tagDict[translate_branch_name(record.data)] = tagMark
+        replace_branch_tree(record.data, tree)
+        branchHeadDict[record.data] = tagMark
+        branchLfsDict[record.data] = lfsPaths
 
     elif record.action == Actions.BRANCH_BASELINE:
         # the idea hers is to simply 'reset' to create our new branch, the name of which is contained in the 'data' field
 
-        print("reset refs/heads/%s" % translate_branch_name(record.data))
+        if record.data in branchBaseDict:
+            # already created during this export.  every file (and every shard) reports the creation of a branch, and
+            # resetting it again would throw away anything committed to it since.
+            return
+
+        stream.command("reset refs/heads/%s" % translate_branch_name(record.data))
+        sessionBranchSet.add(record.data)
+
+        # the new branch inherits the file versions of its parent
+        branchBaseDict[record.data] = (record.branch, dict(branchVersionDict.get(record.branch, {})))
 
         parentBranch = translate_branch_name(record.branch)
-        if is_snapshot_branch(parentBranch, os.path.split(record.path)[0]):
+        if is_snapshot_branch(record.branch, os.path.split(record.path)[0]):
             # Git won't let us refer to the tag directly (maybe this will be fixed in a future version).
             # for now, we have to refer to the associated tag mark instead.
             # (if this is fixed in the future, we can get rid of tagDict altogether)
-            print("from :%d" % tagDict[parentBranch])
+            stream.command("from :%d" % tagDict[parentBranch])
+            branchHeadDict[record.data] = tagDict[parentBranch]
+        elif record.branch not in sessionBranchSet and branchHeadDict.get(record.branch):
+            # baseline branch from an earlier session.  fast-import only knows it by mark.
+            stream.command("from :%d" % branchHeadDict[record.branch])
+            branchHeadDict[record.data] = branchHeadDict[record.branch]
         else:
             # baseline branch
-            print("from refs/heads/%s" % parentBranch)
+            stream.command("from refs/heads/%s" % parentBranch)
+            branchHeadDict[record.data] = branchHeadDict.get(record.branch)
+
+        # ...as well as its tree
+        if record.branch in branchTreeDict:
+            replace_branch_tree(record.data, dict(branchTreeDict[record.branch]))
+            branchLfsDict[record.data] = set(branchLfsDict.get(record.branch, ()))
 
     elif record.action == Actions.FILE_MODIFY or record.action == Actions.FILE_DELETE or record.action == Actions.FILE_RENAME:
         # this is the usual case
+        process_changeset([(record, prefetched)])
+    else:
+        raise Exception("Unknown record action")
+
 
+def process_changeset(changeset):
+    # emits a single commit for a list of (record, prefetched) file operations on the same branch.
+    # without coalescing (see coalesce_records()), every changeset holds exactly one record.
+    global mark
+
+    first = changeset[0][0]
+    last = changeset[-1][0]
+
+    # all blobs have to be in the stream before the commit that refers to them
+    blobMarks = []
+    for record, prefetched in changeset:
         if record.action == Actions.FILE_MODIFY:
-            blobMark = print_blob_for_file(record.branch, record.path, record.version)
-
-        mark = mark + 1
-        print("commit refs/heads/%s" % translate_branch_name(record.branch))
-        print("mark :%d" % mark)
-        print("author %s <%s> %s %s" % (record.author, record.author, record.timestamp, timezone))
-        print("committer %s <%s> %s %s" % (record.author, record.author, record.timestamp, timezone))
-        if record.comment:
-            print("data %d" % len(record.comment))
-            print(record.comment)
+            blobMarks.append(print_blob_for_file(record.mainline, record.branch, record.path, record.version, prefetched))
+            versions = branchVersionDict.setdefault(record.branch, {})
+            versions[record.path] = max(versions.get(record.path, 0), record.version)
         else:
-            print("data 0")
+            blobMarks.append(None)
 
+    # records that were coalesced without 'comment' as a key may have different comments.  keep all of them.
+    comments = []
+    for record, prefetched in changeset:
+        if record.comment and record.comment not in comments:
+            comments.append(record.comment)
+    comment = '\n\n'.join(comments)
+
+    mark = mark + 1
+    stream.command("commit refs/heads/%s" % translate_branch_name(first.branch))
+    stream.command("mark :%d" % mark)
+    stream.command("author %s <%s> %s %s" % (first.author, first.author, last.timestamp, timezone))
+    stream.command("committer %s <%s> %s %s" % (first.author, first.author, last.timestamp, timezone))
+    stream.data(comment or "")
+    if first.branch not in sessionBranchSet:
+        if branchHeadDict.get(first.branch):
+            # first commit on a branch from an earlier session.  continue from its head.
+            stream.command("from :%d" % branchHeadDict[first.branch])
+        sessionBranchSet.add(first.branch)
+
+    # keep our view of the branch in sync with what Git sees
+    tree = branchTreeDict.setdefault(first.branch, {})
+    dirtyPaths = dirtyTreeDict.setdefault(first.branch, set())
+    branchHeadDict[first.branch] = mark
+    # ...and of which of its files are LFS pointers
+    lfsPaths = branchLfsDict.setdefault(first.branch, set())
+    lfsChanged = False
+
+    for (record, prefetched), blobMark in zip(changeset, blobMarks):
         if record.action == Actions.FILE_MODIFY:
             if record.origPath:
                 # looks like there was a previous rename.  use the original name.
-                print("M 100644 :%d %s" % (blobMark, record.origPath))
+                path = record.origPath
             else:
                 # no previous rename.  good to use the current name.
-                print("M 100644 :%d %s" % (blobMark, record.path))
+                path = record.path
+            stream.command("M 100644 :%d %s" % (blobMark, path))
+            tree[path] = blobMark
+            dirtyPaths.add(path)
+            if blobMark in lfsMarkSet and path not in lfsPaths:
+                lfsPaths.add(path)
+                lfsChanged = True
+            elif blobMark not in lfsMarkSet and path in lfsPaths:
+                lfsPaths.remove(path)
+                lfsChanged = True
         elif record.action == Actions.FILE_DELETE:
-            print("D %s" % record.path)
+            stream.command("D %s" % record.path)
+            tree.pop(record.path, None)
+            dirtyPaths.add(record.path)
+            if record.path in lfsPaths:
+                lfsPaths.remove(record.path)
+                lfsChanged = True
         elif record.action == Actions.FILE_RENAME:
             # NOTE we're not using record.path here, as there may have been multiple renames in the file's history
-            print("R %s %s" % (record.origPath, record.data))
+            stream.command("R %s %s" % (record.origPath, record.data))
+            if record.origPath in tree:
+                tree[record.data] = tree.pop(record.origPath)
+            dirtyPaths.update((record.origPath, record.data))
+            if record.origPath in lfsPaths:
+                lfsPaths.remove(record.origPath)
+                lfsPaths.add(record.data)
+                lfsChanged = True
+
+    if lfsChanged:
+        print_lfs_attributes(lfsPaths)
+
+
+def coalesce_records(records, window, keys):
+    # coalescing stage between the database cursor (or the prefetcher) and the stream writer.
+    # groups consecutive file operations on the same branch, with equal 'keys' (record attributes), that start within
+    # 'window' seconds of the first one in the group.  Surround check-ins are per file, so this is what turns an atomic
+    # check-in of many files back into a single commit.  branch operations are never grouped.
+    # yields lists of (record, prefetched).  a group is also cut short when a path shows up twice, so that no
+    # intermediate version of a file is lost.
+    group = []
+    groupPaths = set()
+    for record, prefetched in records:
+        if record.action in (Actions.FILE_MODIFY, Actions.FILE_DELETE, Actions.FILE_RENAME):
+            paths = set(path for path in (record.path, record.origPath, record.data if record.action == Actions.FILE_RENAME else None) if path)
+            if group:
+                first = group[0][0]
+                if record.branch == first.branch \
+                        and record.timestamp - first.timestamp <= window \
+                        and all(getattr(record, key) == getattr(first, key) for key in keys) \
+                        and not (paths & groupPaths):
+                    group.append((record, prefetched))
+                    groupPaths.update(paths)
+                    continue
+                yield group
+            group = [(record, prefetched)]
+            groupPaths = paths
         else:
-            # this is a branch operation
-            if record.data:
-                # record the other ancestor
-                print("merge refs/heads/%s" % translate_branch_name(record.data))
+            if group:
+                yield group
+                group = []
+            yield [(record, prefetched)]
+    if group:
+        yield group
+
+
+def print_snapshot_tags():
+    # writes one annotated tag per snapshot seen during this export
+    for name, (author, timestamp, comment) in snapshotTagDict.items():
+        stream.command("tag %s" % name)
+        stream.command("from :%d" % tagDict[name])
+        stream.command("tagger %s <%s> %s %s" % (author, author, timestamp, timezone))
+        stream.data(comment or "")
+    snapshotTagDict.clear()
+
+
+def iterate_database_records(database, batchSize=1000, afterRowid=0, lastRowid=None, afterPosition=None):
+    # streams records in export order.  rows are pulled in batches via fetchmany, so that memory stays flat and
+    # the first record reaches `git fast-import` right away (the timestamp index avoids a temp sort).
+    c = database.cursor()
+    # TODO this is a temporary hack until we can get granularity of seconds in the timestamp field.
+    #      an alternative would be to topologically sort all items with the same timestamp,
+    #      such that parent branches are created before child branches.
+    #c.execute('''SELECT * FROM operations ORDER BY timestamp, version ASC''')
+    # NOTE ties are broken by rowid (i.e. parse order), which SQLite gets for free from the timestamp index.
+    # NOTE an incremental export only covers the rows added since the last one, which all have higher rowids.
+    # NOTE an export resumed from a checkpoint starts after the (timestamp, rowid) of the last record it had written.
+    # NOTE left to itself, SQLite serves the rowid range from the table instead, and sorts every row in a temp b-tree
+    #      before returning the first one.  the index is forced, so that rows stream in order (and a resume seeks).
+    if lastRowid is None:
+        lastRowid = database.execute('''SELECT MAX(rowid) FROM operations''').fetchone()[0] or 0
+    if afterPosition is None:
+        afterPosition = (-1, 0)
+    c.execute('''SELECT timestamp, action, mainline, branch, path, origPath, version, author, comment, data, rowid FROM operations INDEXED BY operations_by_timestamp WHERE rowid>? AND rowid<=? AND (timestamp, rowid)>(?, ?) ORDER BY timestamp ASC, rowid ASC''', (afterRowid, lastRowid, afterPosition[0], afterPosition[1]))
+    while True:
+        rows = c.fetchmany(batchSize)
+        if not rows:
+            break
+        for row in rows:
+            yield DatabaseRecord(row)
+
+
+def merge_database_records(databases, batchSize=1000):
+    # k-way merge of the records of several databases (shards), by timestamp.  ties are broken by the order of the
+    # shards, then by the order within each shard, so the result doesn't depend on the order that heapq compares in.
+    def keyed_records(shard, database):
+        for index, record in enumerate(iterate_database_records(database, batchSize)):
+            yield (record.timestamp, shard, index), record
+
+    for key, record in heapq.merge(*[keyed_records(shard, database) for shard, database in enumerate(databases)]):
+        yield record
+
+
+def save_export_state(database, lastRowid, lastTimestamp, checkpoint=None):
+    # persists everything needed to continue the fast-import stream in a later run.
+    # marks are only meaningful to fast-import if it is run with --import-marks/--export-marks.
+    # 'lastRowid' and 'lastTimestamp' describe the last completed export (see 'sync').  while an export is underway,
+    # 'checkpoint' describes how far it got (see cmd_export()), and the tags it hasn't written yet are kept as well.
+    # the tables only receive what has changed since the last save (see dirtyTreeDict), so that frequent checkpoints
+    # don't cost a rewrite of the whole state each.  a checkpoint doesn't replace the state of the last completed
+    # export, but is kept next to it (along with a few before it, see checkpointsKept) until the export is complete.
+    c = database.cursor()
+    state = {"mark": mark,
+             "checkpoint": checkpoint,
+             "pendingTags": list(snapshotTagDict.items()),
+             "tags": tagDict,
+             "heads": branchHeadDict,
+             "lfsMarks": sorted(lfsMarkSet),
+             "lastRowid": lastRowid,
+             "lastTimestamp": lastTimestamp}
+    treeKeys = set()
+    for branch, paths in dirtyTreeDict.items():
+        tree = branchTreeDict.get(branch, {})
+        c.executemany('''INSERT OR REPLACE INTO export_trees VALUES (?, ?, ?, ?)''', ((branch, path, mark, tree.get(path)) for path in paths))
+        treeKeys.update((branch, path) for path in paths)
+    c.executemany('''INSERT OR REPLACE INTO export_blobs VALUES (?, ?)''', ((digest, blobHashDict[digest]) for digest in dirtyBlobHashes))
+    c.executemany('''INSERT OR REPLACE INTO export_files VALUES (?, ?, ?, ?)''', (key + (blobMarkDict[key],) for key in dirtyBlobMarks))
+    if checkpoint:
+        c.execute('''INSERT OR REPLACE INTO export_checkpoints VALUES (?, ?)''', (mark, json.dumps(state)))
+        checkpointTreeKeys.append((mark, treeKeys))
+        oldest = c.execute('''SELECT mark FROM export_checkpoints ORDER BY mark DESC LIMIT 1 OFFSET ?''', (checkpointsKept - 1,)).fetchone()
+        if oldest:
+            c.execute('''DELETE FROM export_checkpoints WHERE mark<?''', oldest)
+            foldKeys = set()
+            while checkpointTreeKeys and checkpointTreeKeys[0][0] <= oldest[0]:
+                foldKeys.update(checkpointTreeKeys.popleft()[1])
+            fold_export_trees(c, foldKeys, oldest[0])
     else:
-        raise Exception("Unknown record action")
+        c.executemany('''INSERT OR REPLACE INTO export_state VALUES (?, ?)''', [(key, json.dumps(value)) for key, value in state.items()])
+        c.execute('''DELETE FROM export_checkpoints''')
+        while checkpointTreeKeys:
+            treeKeys.update(checkpointTreeKeys.popleft()[1])
+        fold_export_trees(c, treeKeys, mark)
+    database.commit()
+    dirtyTreeDict.clear()
+    del dirtyBlobHashes[:]
+    del dirtyBlobMarks[:]
+
 
+def fold_export_trees(c, keys, generation):
+    # of the rows of each (branch, path) in 'keys', drops those that no state as of 'generation' or later needs:  rows
+    # followed by another one up to 'generation', and then the row of a deleted path
+    c.executemany('''DELETE FROM export_trees WHERE branch=? AND path=? AND generation<(SELECT MAX(generation) FROM export_trees WHERE branch=? AND path=? AND generation<=?)''',
+                  ((branch, path, branch, path, generation) for branch, path in keys))
+    c.executemany('''DELETE FROM export_trees WHERE branch=? AND path=? AND generation<=? AND mark IS NULL''', ((branch, path, generation) for branch, path in keys))
 
-def get_next_database_record(database, c):
-    if not c:
-        c = database.cursor()
-        # TODO this is a temporary hack until we can get granularity of seconds in the timestamp field.
-        #      an alternative would be to topologically sort all items with the same timestamp,
-        #      such that parent branches are created before child branches.
-        #c.execute('''SELECT * FROM operations ORDER BY timestamp, version ASC''')
-        c.execute('''SELECT * FROM operations ORDER BY timestamp ASC''')
-    return c, c.fetchone()
 
+def load_export_state(database, highestMark=None):
+    # restores the state saved by save_export_state(), and returns it as a dict (None if there is none).
+    # with 'highestMark', it is the state of the newest checkpoint kept whose mark is no higher than that instead.
+    global mark
 
-def cmd_export(database):
+    if highestMark is None:
+        state = dict((key, json.loads(value)) for key, value in database.execute('''SELECT key, value FROM export_state'''))
+        if "mark" not in state:
+            return None
+    else:
+        row = database.execute('''SELECT state FROM export_checkpoints WHERE mark<=? ORDER BY mark DESC LIMIT 1''', (highestMark,)).fetchone()
+        if not row:
+            return None
+        state = json.loads(row[0])
+    # rows written later (by an export that is still underway, or that got further than the checkpoint) don't count
+    mark = state["mark"]
+    for name, tag in state.get("pendingTags", []):
+        snapshotTagDict[name] = tuple(tag)
+    tagDict.update(state["tags"])
+    branchHeadDict.update(state["heads"])
+    for branch, path, blobMark in database.execute('''SELECT branch, path, mark FROM export_trees t WHERE mark IS NOT NULL AND
+                                                        generation=(SELECT MAX(generation) FROM export_trees WHERE branch=t.branch AND path=t.path AND generation<=?)''', (mark,)):
+        branchTreeDict.setdefault(branch, {})[path] = blobMark
+    lfsMarkSet.update(state.get("lfsMarks", []))
+    for branch, tree in branchTreeDict.items():
+        branchLfsDict[branch] = set(path for path, blobMark in tree.items() if blobMark in lfsMarkSet)
+    for digest, blobMark in database.execute('''SELECT hash, mark FROM export_blobs WHERE mark<=?''', (mark,)):
+        blobHashDict[digest] = blobMark
+    for branch, path, version, blobMark in database.execute('''SELECT branch, path, version, mark FROM export_files WHERE mark<=?''', (mark,)):
+        blobMarkDict[(branch, path, version)] = blobMark
+    return state
+
+
+def find_highest_mark(marksPath):
+    # the highest mark in a marks file written by fast-import (--export-marks).  fast-import writes it at every
+    # `checkpoint`, so this tells how far it got.  0 if it hasn't written the file yet.
+    highestMark = 0
+    if os.path.isfile(marksPath):
+        with open(marksPath) as f:
+            for line in f:
+                if line.startswith(":"):
+                    highestMark = max(highestMark, int(line[1:].split(None, 1)[0]))
+    return highestMark
+
+
+def cmd_export(databases, prefetch=0, jobs=1, incremental=False, coalesceWindow=None, coalesceKeys=("author", "comment"), resume=False, checkpointRecords=0, checkpointSize=0, marksPath=None):
+    # 'databases' are one or more shards, e.g. from parse jobs for different mainlines or paths on different hosts.
+    # they are merged into a single stream.  export state (for 'sync') is only kept when exporting a single database.
+    # every 'checkpointRecords' records or 'checkpointSize' bytes of stream, fast-import is told to write out what it
+    # has so far, and (for a single database) the export state is saved, so that 'resume' can continue from there.
+    # the state is saved as soon as the checkpoint is in the stream, before fast-import has got to it, so 'resume'
+    # continues from the newest checkpoint that fast-import has written its marks for, to 'marksPath'.
     sys.stderr.write("\n[+] Beginning export phase...\n")
+    begin_stats_phase("export")
+
+    global fileIndexDatabases, stream
+
+    if stream is None:
+        stream = StreamWriter(getattr(sys.stdout, "buffer", sys.stdout), streamBufferSize)
+    fileIndexDatabases = databases
+    for database in databases:
+        # databases written by older versions (or interrupted parses) may lack indexes
+        create_database_indexes(database)
+        load_branch_catalog(database)
+
+    # the last completed export.  this is what the export state keeps describing until this one is complete.
+    previousRowid, previousTimestamp = 0, None
+    if len(databases) == 1:
+        database = databases[0]
+        afterRowid = 0
+        afterPosition = None
+        state = None
+        if resume:
+            highestMark = find_highest_mark(marksPath)
+            state = load_export_state(database, highestMark)
+            if not state:
+                raise Exception("No checkpoint found in database that fast-import got to (its marks in '%s' go up to %d).  Nothing to resume." % (marksPath, highestMark))
+            # whatever was saved past the checkpoint is written again
+            database.execute('''DELETE FROM export_checkpoints WHERE mark>?''', (mark,))
+            database.execute('''DELETE FROM export_trees WHERE generation>?''', (mark,))
+            database.execute('''DELETE FROM export_blobs WHERE mark>?''', (mark,))
+            database.execute('''DELETE FROM export_files WHERE mark>?''', (mark,))
+            database.commit()
+        elif incremental:
+            state = load_export_state(database)
+        if not state:
+            # a fresh export.  save_export_state() only writes what changes, so left-overs of an earlier one must go
+            for table in ("export_trees", "export_blobs", "export_files", "export_checkpoints"):
+                database.execute('''DELETE FROM %s''' % table)
+            database.commit()
+        if state:
+            previousRowid, previousTimestamp = state.get("lastRowid") or 0, state.get("lastTimestamp")
+        if resume:
+            # same range of rows as the interrupted export, after the last record it had written
+            checkpoint = state["checkpoint"]
+            afterRowid, lastRowid, lastTimestamp = checkpoint["afterRowid"], checkpoint["lastRowid"], checkpoint["lastTimestamp"]
+            afterPosition = (checkpoint["timestamp"], checkpoint["rowid"])
+            sys.stderr.write("[*] Resuming from mark %d ...\n" % mark)
+        else:
+            if state:
+                afterRowid = previousRowid
+                sys.stderr.write("[*] Continuing from mark %d ...\n" % mark)
+            lastRowid, lastTimestamp = database.execute('''SELECT MAX(rowid), MAX(timestamp) FROM operations''').fetchone()
+            lastRowid = lastRowid or 0
+
+        records = iterate_database_records(database, afterRowid=afterRowid, lastRowid=lastRowid, afterPosition=afterPosition)
+    else:
+        sys.stderr.write("[*] Merging %d databases ...\n" % len(databases))
+        records = merge_database_records(databases)
+    if prefetch > 0:
+        # fetch upcoming blobs concurrently, while this thread remains the only writer to the stream
+        records = prefetch_blobs(records, prefetch, max(1, jobs))
+    else:
+        records = ((record, None) for record in records)
+
+    if coalesceWindow is not None:
+        changesets = coalesce_records(records, coalesceWindow, coalesceKeys)
+    else:
+        changesets = ([item] for item in records)
 
     count = 0
-    c, record = get_next_database_record(database, None)
-    count = count + 1
-    while (record):
-        process_database_record(DatabaseRecord(record))
-        c, record = get_next_database_record(database, c)
-
-        count = count + 1
-        # print progress every 10 operations
-        if count % 10 == 0:
-            # just print the date we're currently servicing
-            print("progress", time.strftime('%Y-%m-%d', time.localtime(record[0])))
+    recordsSinceCheckpoint = 0
+    bytesAtCheckpoint = stream.bytesWritten
+    waitStart = time.time()
+    for changeset in changesets:
+        # time spent waiting for records (SQLite, and prefetched blobs) vs. time spent writing them to the stream
+        processStart = time.time()
+        record_timing("export wait for records", processStart - waitStart)
+        if len(changeset) > 1:
+            process_changeset(changeset)
+        else:
+            process_database_record(changeset[0][0], changeset[0][1])
+        record_timing("export changeset", time.time() - processStart)
+        count_stat("records exported", len(changeset))
+        count_stat("commits exported")
+
+        for record, prefetched in changeset:
+            count = count + 1
+            # print progress every 10 operations
+            if count % 10 == 0:
+                # just print the date we're currently servicing
+                stream.command("progress " + time.strftime('%Y-%m-%d', time.localtime(record.timestamp)))
+
+        recordsSinceCheckpoint = recordsSinceCheckpoint + len(changeset)
+        if (checkpointRecords and recordsSinceCheckpoint >= checkpointRecords) or (checkpointSize and stream.bytesWritten - bytesAtCheckpoint >= checkpointSize):
+            stream.command("checkpoint")
+            stream.flush()
+            count_stat("checkpoints")
+            if len(databases) == 1:
+                # only ever saved once everything up to here has been handed to fast-import
+                last = changeset[-1][0]
+                save_export_state(databases[0], previousRowid, previousTimestamp,
+                                  {"timestamp": last.timestamp, "rowid": last.rowid, "afterRowid": afterRowid, "lastRowid": lastRowid, "lastTimestamp": lastTimestamp})
+            recordsSinceCheckpoint = 0
+            bytesAtCheckpoint = stream.bytesWritten
+        waitStart = time.time()
+
+    print_snapshot_tags()
+    stream.flush()
+    count_stat("stream bytes written", stream.bytesWritten)
+    if blobStore:
+        blobStore.close()
+
+    # keep any branches we had to look up along the way
+    for database in databases:
+        save_branch_catalog(database)
+    if len(databases) == 1:
+        save_export_state(databases[0], lastRowid, lastTimestamp)
 
     # cleanup
     try:
@@ -585,37 +2227,255 @@ def cmd_export(database):
         # TODO why doesn't this work?  is this too early since we're piping our output, and then `git fast-import` just creates it again?
         os.remove("./.git/TAG_FIXUP")
 
+    end_stats_phase()
     sys.stderr.write("\n[+] Export complete.  Your new Git repository is ready to use.\nDon't forget to run `git repack` at some future time to improve data locality and access performance.\n\n")
 
 
-def cmd_verify(mainline, path):
-    # TODO verify that all Surround baseline branches are identical to their Git counterparts
-    # TODO verify that all Surround snapshot branches are identical to their Git counterparts
-    # should be able to do this without database
-    pass
+def cmd_sync(mainline, path, database, jobs=1, transactionSize=10000, prefetch=0, coalesceWindow=None, coalesceKeys=("author", "comment"), checkpointRecords=0, checkpointSize=0):
+    # incremental re-sync of a Git mirror, for use until Surround is frozen.
+    # history is only fetched for (branch, file) pairs that `sscm ls` shows have changed (and the branches related to
+    # them), only operations at or after the last exported timestamp are kept, and only new rows are exported.
+    row = database.execute('''SELECT value FROM export_state WHERE key=?''', ("lastTimestamp",)).fetchone()
+    if not row:
+        raise Exception("No export state found in database.  Run a full export first.")
+    lastTimestamp = json.loads(row[0])
+    if database.execute('''SELECT 1 FROM export_checkpoints LIMIT 1''').fetchone():
+        raise Exception("An interrupted export was found in database.  Finish it first with 'export --resume'.")
+
+    # the queue of the last parse is done with.  cmd_parse() queues the changed pairs.
+    database.execute('''DELETE FROM parsed_files''')
+    database.execute('''DELETE FROM queued_files''')
+    database.commit()
+    cmd_parse(mainline, path, database, jobs, transactionSize, lastTimestamp)
+    cmd_export([database], prefetch, jobs, True, coalesceWindow, coalesceKeys, False, checkpointRecords, checkpointSize)
+
+
+def hash_git_blob(localPath, lfsThreshold=None):
+    # the name Git gives the content of a file as a blob:  the SHA-1 of "blob <size>\0" followed by the content.
+    # files above 'lfsThreshold' were exported as LFS pointers (see print_lfs_pointer()), so those get the name of
+    # their pointer instead.  the file is read in chunks, so memory usage doesn't depend on file size.
+    size = os.path.getsize(localPath)
+    digest = hashlib.sha1(("blob %d\0" % size).encode("ascii"))
+    lfsDigest = None
+    if lfsThreshold is not None and size > lfsThreshold:
+        lfsDigest = hashlib.sha256()
+    with open(localPath, "rb") as f:
+        for chunk in iter(lambda: f.read(blobChunkSize), b""):
+            digest.update(chunk)
+            if lfsDigest:
+                lfsDigest.update(chunk)
+    if lfsDigest:
+        pointer = lfs_pointer(lfsDigest.hexdigest(), size).encode("ascii")
+        return hashlib.sha1(("blob %d\0" % len(pointer)).encode("ascii") + pointer).hexdigest()
+    return digest.hexdigest()
+
+
+def verify_hash_worker(item):
+    # runs in a verify worker process
+    fullPath, localPath, lfsThreshold = item
+    return fullPath, hash_git_blob(localPath, lfsThreshold)
+
+
+def find_git_tree(ref, path):
+    # returns {path: blob name} for every file under 'path' in a Git ref, from a single `git ls-tree` (None if there is
+    # no such ref).  the output is parsed as it arrives.
+    with open(os.devnull, 'w') as fnull:
+        p = subprocess.Popen(["git", "ls-tree", "-r", "-z", "--full-tree", ref, "--", path], stdout=subprocess.PIPE, stderr=fnull)
+        tree = {}
+        pending = b""
+        for chunk in iter(lambda: p.stdout.read(blobChunkSize), b""):
+            entries = (pending + chunk).split(b"\0")
+            pending = entries.pop()
+            for entry in entries:
+                info, name = entry.split(b"\t", 1)
+                mode, objectType, objectName = info.split(b" ")
+                if objectType == b"blob":
+                    tree[name.decode("utf-8")] = objectName.decode("ascii")
+        p.stdout.close()
+        p.wait()
+    if p.returncode:
+        return None
+    return tree
+
+
+def report_mismatch(branch, ref, path, status, surroundName=None, gitName=None):
+    # one JSON object per line on stdout, so that the results can be processed further
+    result = collections.OrderedDict([("branch", branch), ("ref", ref), ("path", path), ("status", status), ("surround", surroundName), ("git", gitName)])
+    with verifyLock:
+        sys.stdout.write(json.dumps(result) + "\n")
+        sys.stdout.flush()
+
+
+def verify_branch(branch, path, hashPool, lfsThreshold):
+    # compares the newest state of 'path' on a Surround branch with the Git branch (or tag, for a snapshot) it was
+    # exported to.  returns (ref, number of files, number of mismatches).
+    if is_snapshot_branch(branch, path):
+        ref = "refs/tags/" + translate_branch_name(branch)
+    else:
+        ref = "refs/heads/" + translate_branch_name(branch)
+    gitTree = find_git_tree(ref, path)
+
+    numFiles = 0
+    numMismatches = 0
+    stagingDir = fetch_tree(branch, path)
+    try:
+        if gitTree is None:
+            # `lsbranch` also lists branches with nothing under 'path' (see find_all_branches_in_mainline_containing_path()),
+            # and the export creates no ref for those.  only a branch with files there is missing one.
+            numFiles = len(list(find_all_files_in_tree(stagingDir, path)))
+            if numFiles:
+                report_mismatch(branch, ref, None, "missing ref")
+                numMismatches = 1
+            count_stat("files verified", numFiles)
+            return ref, numFiles, numMismatches
+        items = ((fullPath, localPath, lfsThreshold) for fullPath, localPath in find_all_files_in_tree(stagingDir, path))
+        if hashPool:
+            results = hashPool.imap_unordered(verify_hash_worker, items, 64)
+        else:
+            results = (verify_hash_worker(item) for item in items)
+        for fullPath, blobName in results:
+            numFiles = numFiles + 1
+            gitName = gitTree.pop(fullPath, None)
+            if gitName is None:
+                report_mismatch(branch, ref, fullPath, "missing in git", blobName)
+                numMismatches = numMismatches + 1
+            elif gitName != blobName:
+                report_mismatch(branch, ref, fullPath, "content differs", blobName, gitName)
+                numMismatches = numMismatches + 1
+    finally:
+        shutil.rmtree(stagingDir, ignore_errors=True)
+
+    # whatever is left exists in Git only
+    for fullPath in sorted(gitTree):
+        report_mismatch(branch, ref, fullPath, "missing in surround", None, gitTree[fullPath])
+        numMismatches = numMismatches + 1
+    count_stat("files verified", numFiles)
+    return ref, numFiles, numMismatches
+
+
+def cmd_verify(mainline, path, jobs=1, database=None):
+    # verifies that every Surround branch (mainline, baselines and snapshots) is identical to its Git counterpart.
+    # must be run inside the Git repository, after the export has completed (or after a 'sync').
+    # mismatches are written to stdout as JSON lines (see report_mismatch()).  returns the number of mismatches.
+    # branches are verified in parallel, each with one recursive `sscm get` and one `git ls-tree`, and the files
+    # are hashed on a pool of processes.  no database is needed, but its branch catalog saves asking the server.
+    sys.stderr.write("[+] Beginning verify phase...")
+    begin_stats_phase("verify")
+
+    # the processes are started before any threads, which a fork would not carry over cleanly
+    hashPool = None
+    if jobs > 1:
+        hashPool = multiprocessing.Pool(jobs)
+
+    if database:
+        load_branch_catalog(database)
+    branches = find_all_branches_in_mainline_containing_path(mainline, path)
+    catalog_branches(branches, path, jobs)
+
+    if not os.path.isdir(scratchDir):
+        os.makedirs(scratchDir)
+    branchPool = ThreadPool(jobs)
+    numMismatches = 0
+    try:
+        verified = branchPool.imap_unordered(lambda branch: (branch, verify_branch(branch, path, hashPool, lfsThreshold)), branches)
+        for branch, (ref, numBranchFiles, numBranchMismatches) in verified:
+            sys.stderr.write("\n[*] Verified branch '%s' against %s:  %d files, %d mismatches" % (branch, ref, numBranchFiles, numBranchMismatches))
+            numMismatches = numMismatches + numBranchMismatches
+    finally:
+        branchPool.terminate()
+        branchPool.join()
+        if hashPool:
+            hashPool.terminate()
+            hashPool.join()
+
+    end_stats_phase()
+    if numMismatches:
+        sys.stderr.write("\n[+] Verify phase complete:  %d mismatches in %d branches\n" % (numMismatches, len(branches)))
+    else:
+        sys.stderr.write("\n[+] Verify phase complete:  all %d branches match\n" % len(branches))
+    return numMismatches
 
 
 def handle_command(parser):
+    global sscmExe, bulkFetch, blobStore, lfsThreshold, stream, historyBackend, sscmhistCmd, statsFile, statsInterval
+
     args = parser.parse_args()
+    if args.output_fd:
+        # write the fast-import stream to another file descriptor (e.g. to keep stdout free for other output)
+        stream = StreamWriter(os.fdopen(args.output_fd[0], "wb"), streamBufferSize)
+    sscmExe = args.sscm[0]
+    checkpointRecords = args.checkpoint_records[0]
+    checkpointSize = args.checkpoint_size[0] * 1024 * 1024
+    bulkFetch = args.bulk_fetch
+    lfsThreshold = args.lfs_threshold[0]
+    if args.blob_store:
+        blobStore = BlobStore(args.blob_store[0], args.blob_store_size[0] * 1024 * 1024)
+    if args.stats:
+        statsFile = args.stats[0]
+        statsInterval = args.stats_interval[0]
+    historyBackend = args.history_backend
+    if historyBackend == "sscmhist":
+        if not args.sscmhist:
+            parser.error("--history-backend sscmhist requires --sscmhist")
+        sscmhistCmd = shlex.split(args.sscmhist[0])
+    # records are always coalesced per branch.  the other keys are configurable.
+    coalesceKeys = tuple(key for key in args.coalesce_keys[0].split(',') if key and key != "branch")
+    for key in coalesceKeys:
+        if key not in ("author", "comment"):
+            parser.error("unknown coalesce key '%s' (expected: author, comment)" % key)
 
     if args.command == "parse" and args.mainline and args.path:
         verify_surround_environment()
-        database = create_database()
-        cmd_parse(args.mainline[0], args.path[0], database)
+        if args.resume and not args.database:
+            parser.error("--resume requires -d/--database")
+        if args.database:
+            # e.g. one shard of a parse that is split over several processes or hosts.  an existing database is only
+            # added to with --resume, so that a typo neither starts over in a new file nor mixes two parses.
+            if args.resume and not is_parse_database(args.database[0]):
+                parser.error("--resume: '%s' is not the database of an earlier parse" % args.database[0])
+            database = open_database(args.database[0], args.fast_database)
+            if not args.resume and database.execute('''SELECT EXISTS (SELECT 1 FROM parsed_files) OR EXISTS (SELECT 1 FROM operations)''').fetchone()[0]:
+                parser.error("database '%s' already holds a parse.  use --resume to continue it, or give a new database" % args.database[0])
+        else:
+            database = create_database(args.fast_database)
+        cmd_parse(args.mainline[0], args.path[0], database, args.jobs[0], args.transaction_size[0])
     elif args.command == "export" and args.database:
         verify_surround_environment()
-        cmd_export(args.database[0])
+        # several databases (shards) are merged into one stream
+        if args.resume and len(args.database) > 1:
+            parser.error("--resume requires a single -d/--database")
+        if args.resume and not args.marks_file:
+            parser.error("--resume requires --marks-file, to tell which checkpoint fast-import got to")
+        databases = [open_database(name, args.fast_database) for name in args.database]
+        cmd_export(databases, args.prefetch[0], args.jobs[0], False, args.coalesce_window[0], coalesceKeys, args.resume, checkpointRecords, checkpointSize, args.marks_file and args.marks_file[0])
     elif args.command == "all" and args.mainline and args.path:
         # typical case
         verify_surround_environment()
-        database = create_database()
-        cmd_parse(args.mainline[0], args.path[0], database)
-        cmd_export(database)
+        database = create_database(args.fast_database)
+        cmd_parse(args.mainline[0], args.path[0], database, args.jobs[0], args.transaction_size[0])
+        cmd_export([database], args.prefetch[0], args.jobs[0], False, args.coalesce_window[0], coalesceKeys, False, checkpointRecords, checkpointSize)
+    elif args.command == "sync" and args.mainline and args.path and args.database:
+        # incremental update of an earlier export
+        if len(args.database) > 1:
+            parser.error("sync requires a single -d/--database")
+        verify_surround_environment()
+        database = open_database(args.database[0], args.fast_database)
+        cmd_sync(args.mainline[0], args.path[0], database, args.jobs[0], args.transaction_size[0], args.prefetch[0], args.coalesce_window[0], coalesceKeys, checkpointRecords, checkpointSize)
+    elif args.command == "reparse" and args.mainline and args.path and args.database:
+        # rebuilds the operations of an earlier parse from its stored history, offline
+        if len(args.database) > 1:
+            parser.error("reparse requires a single -d/--database")
+        database = open_database(args.database[0], args.fast_database)
+        cmd_reparse(args.mainline[0], args.path[0], database, args.jobs[0], args.transaction_size[0])
     elif args.command == "verify" and args.mainline and args.path:
         # the 'verify' operation must take place after the export has completed.
         # as such, it will always be conducted as its own separate operation.
         verify_surround_environment()
-        cmd_verify(args.mainline[0], args.path[0])
+        database = None
+        if args.database:
+            database = open_database(args.database[0])
+        if cmd_verify(args.mainline[0], args.path[0], args.jobs[0], database):
+            sys.exit(1)
     else:
         parser.print_help()
         sys.exit(1)
@@ -625,10 +2485,30 @@ def parse_arguments():
     parser = argparse.ArgumentParser(prog='export-surround-to-git.py', description='Exports history from Seapine Surround in a format parsable by `git fast-import`.', formatter_class=argparse.RawDescriptionHelpFormatter)
     parser.add_argument('-m', '--mainline', nargs=1, help='Mainline branch containing history to export')
     parser.add_argument('-p', '--path', nargs=1, help='Path containing history to export')
-    parser.add_argument('-d', '--database', nargs=1, help='Path to local database (only used when resuming an export)')
+    parser.add_argument('-d', '--database', action='append', help='Path to local database.  parse writes to it (default: a new database named after the current time), and only adds to an earlier parse with --resume.  export reads from it, and may be given several times to merge databases of separate parse jobs')
+    parser.add_argument('--resume', action='store_true', help='Resume an interrupted parse into the database given by -d, which must exist, or an interrupted export from the last checkpoint that fast-import got to (see --checkpoint-records and --marks-file)')
+    parser.add_argument('-j', '--jobs', nargs=1, type=int, default=[1], help='Number of parallel workers used to fetch history during the parse phase, to interpret it during reparse, to fetch files during the export phase, and to verify branches (default: 1)')
+    parser.add_argument('--transaction-size', nargs=1, type=int, default=[10000], help='Number of records and parsed files written to the database per transaction during the parse phase (default: 10000)')
+    parser.add_argument('--fast-database', action='store_true', help='Use WAL journaling and disable fsync for the database (only use this for throwaway databases)')
+    parser.add_argument('--prefetch', nargs=1, type=int, default=[0], help='Number of records to look ahead during the export phase, fetching their files on --jobs workers (default: 0, disabled)')
+    parser.add_argument('--bulk-fetch', action='store_true', help='Fetch each snapshot with a single recursive `sscm get` instead of one `sscm get` per file')
+    parser.add_argument('--blob-store', nargs=1, help='Directory of a local store of fetched file versions, shared between export runs.  versions found there are not fetched from Surround again')
+    parser.add_argument('--blob-store-size', nargs=1, type=int, default=[10240], help='Size limit of the --blob-store in MiB.  the least recently used files are evicted beyond it (default: 10240)')
+    parser.add_argument('--lfs-threshold', nargs=1, type=int, default=[None], help='Store files larger than this many bytes in the local Git LFS object store (.git/lfs/objects), and export LFS pointers and .gitattributes entries for them instead (default: disabled).  run `git lfs install` in the repository to check them out')
+    parser.add_argument('--coalesce-window', nargs=1, type=int, default=[None], help='Coalesce consecutive file operations on the same branch that are at most this many seconds apart (measured from the first one) into a single commit (default: disabled, one commit per file operation)')
+    parser.add_argument('--coalesce-keys', nargs=1, default=['author,comment'], help='Comma-separated record fields that must also be equal for file operations to be coalesced, out of author and comment (default: author,comment)')
+    parser.add_argument('--checkpoint-records', nargs=1, type=int, default=[0], help='Have fast-import write out everything so far (`checkpoint`) every this many records during the export, and save the export state, so that an interrupted export can be continued with --resume (default: 0, disabled)')
+    parser.add_argument('--checkpoint-size', nargs=1, type=int, default=[0], help='Same as --checkpoint-records, but every this many MiB of stream (default: 0, disabled)')
+    parser.add_argument('--marks-file', nargs=1, help='The file fast-import exports its marks to (its --export-marks).  export --resume continues from the newest checkpoint that fast-import wrote it for')
+    parser.add_argument('--stats', nargs=1, help='Append a JSON report (one object per line) of call counts, latency histograms, bytes and rates to this file at the end of each phase')
+    parser.add_argument('--stats-interval', nargs=1, type=int, default=[0], help='Also append an interim --stats report every this many seconds during each phase (default: 0, disabled)')
+    parser.add_argument('--output-fd', nargs=1, type=int, help='File descriptor to write the fast-import stream to (default: stdout)')
+    parser.add_argument('--sscm', nargs=1, default=['sscm'], help='Path to the sscm command-line client (default: sscm)')
+    parser.add_argument('--history-backend', choices=['cli', 'sscmhist'], default='cli', help='How file history is fetched during the parse phase:  by parsing `sscm history` output, or from a long-lived sscmhist helper using the Surround API (see sscmhist/) (default: cli)')
+    parser.add_argument('--sscmhist', nargs=1, help='Command line of the sscmhist helper, including its connection arguments, e.g. "sscmhist/sscmhist host 4900 user password"')
     parser.add_argument('--version', action='version', version='%(prog)s ' + VERSION)
     parser.add_argument('command', nargs='?', default='all')
-    parser.epilog = "Example flow:\n\tsscm setclient ...\n\tgit init my-new-repo\n\tcd my-new-repo\n\texport-surround-to-git.py -m Sandbox -p \"Sandbox/Merge Test\" -f blah.txt | git fast-import --stats --export-marks=marks.txt\n\t...\n\tgit repack ..."
+    parser.epilog = "Example flow:\n\tsscm setclient ...\n\tgit init my-new-repo\n\tcd my-new-repo\n\texport-surround-to-git.py -m Sandbox -p \"Sandbox/Merge Test\" -f blah.txt | git fast-import --stats --export-marks=marks.txt\n\t...\n\tgit repack ...\n\nIncremental sync (after a full export into the same database):\n\texport-surround-to-git.py -m Sandbox -p \"Sandbox/Merge Test\" -d 20140101000000.db sync | git fast-import --import-marks=marks.txt --export-marks=marks.txt\n\nRebuilding the operations of a parse from its stored history, after changing how history is interpreted:\n\texport-surround-to-git.py -m Sandbox -p \"Sandbox/Merge Test\" -d 20140101000000.db reparse\n\nLong export with checkpoints, continued after a failure:\n\texport-surround-to-git.py -d 20140101000000.db --checkpoint-records 100000 export | git fast-import --export-marks=marks.txt\n\texport-surround-to-git.py -d 20140101000000.db --resume export | git fast-import --import-marks=marks.txt --export-marks=marks.txt\n\nVerifying every branch and snapshot of an export (inside the Git repository, mismatches as JSON lines):\n\texport-surround-to-git.py -m Sandbox -p \"Sandbox/Merge Test\" -j 8 verify > mismatches.jsonl\n\nSharded parse (e.g. one parse job per path, each on its own host), merged into a single export:\n\texport-surround-to-git.py -m Sandbox -p \"Sandbox/Merge Test\" -d merge-test.db parse\n\texport-surround-to-git.py -m Sandbox -p \"Sandbox/Other\" -d other.db parse\n\texport-surround-to-git.py -d merge-test.db -d other.db export | git fast-import --stats --export-marks=marks.txt"
     return parser
 
 
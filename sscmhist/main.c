@@ -1,7 +1,163 @@
 #include <stdio.h>
 #include <stdlib.h>
+#include <string.h>
 #include "sscmapi.h"
 
+// usage:
+//   sscmhist host port username password mainline branch repo file [version]
+//     prints the history of a single file, then exits.
+//   sscmhist host port username password mainline
+//     connects once, then answers queries read from stdin, one per line:
+//       branch<TAB>repo<TAB>file
+//     each answer is zero or more history lines in the same format as above (without the header),
+//     followed by a line containing only "END".  failed queries are answered with "ERROR<TAB>message" instead.
+//
+// every history line has the fields:
+//   version<TAB>date<TAB>action<TAB>actionBranch<TAB>actionVersion<TAB>username<TAB>comment
+// where action is named like `sscm history` does (e.g. "checkin"), and the comment has backslashes, tabs and line
+// breaks escaped as \\, \t, \n and \r.  actions this helper doesn't know are named "unknown <number>".
+
+// names of the history actions of the API, as printed by `sscm history`.  the numeric values are private to the
+// API, so only the named constants of sscmapi.h are used here.
+static const struct {
+    int action;
+    const char *pName;
+} actionNames[] = {
+    { Add,                 "add" },
+    { AddToRepository,     "add to repository" },
+    { AddToBranch,         "add to branch" },
+    { AddFromBranch,       "add from branch" },
+    { AttachToIssue,       "attach to issue" },
+    { AttachToTestCase,    "attach to test case" },
+    { AttachToRequirement, "attach to requirement" },
+    { AttachToObservation, "attach to observation" },
+    { AttachToExternal,    "attach to external" },
+    { BreakShare,          "break share" },
+    { CheckIn,             "checkin" },
+    { Delete,              "delete" },
+    { Duplicate,           "duplicate" },
+    { FileDestroyed,       "file destroyed" },
+    { FileMoved,           "file moved" },
+    { FileRenamed,         "file renamed" },
+    { InLabel,             "in label" },
+    { Label,               "label" },
+    { Moved,               "moved" },
+    { PromoteFrom,         "promote from" },
+    { PromoteTo,           "promote to" },
+    { RebaseFrom,          "rebase from" },
+    { RebaseWithMerge,     "rebase with merge" },
+    { Remove,              "remove" },
+    { Renamed,             "renamed" },
+    { RepoDestroyed,       "repo destroyed" },
+    { RepoMoved,           "repo moved" },
+    { RepoRenamed,         "repo renamed" },
+    { Restore,             "restore" },
+    { Share,               "share" },
+    { RollbackFile,        "rollback file" },
+    { RollbackRebase,      "rollback rebase" },
+    { RollbackPromote,     "rollback promote" },
+};
+
+static void print_action_name(int action)
+{
+    for (size_t i = 0; i < sizeof(actionNames) / sizeof(actionNames[0]); i++) {
+        if (actionNames[i].action == action) {
+            fputs(actionNames[i].pName, stdout);
+            return;
+        }
+    }
+    printf("unknown %d", action);
+}
+
+static void print_escaped(const char *pText)
+{
+    for (; pText != NULL && *pText != '\0'; pText++) {
+        switch (*pText) {
+        case '\\': fputs("\\\\", stdout); break;
+        case '\t': fputs("\\t", stdout); break;
+        case '\n': fputs("\\n", stdout); break;
+        case '\r': fputs("\\r", stdout); break;
+        default:   putchar(*pText); break;
+        }
+    }
+}
+
+static void print_history_items(struct FileHistoryItem **ppItems, int numOfHistoryItems, unsigned int version)
+{
+    for (int i = 0; i < numOfHistoryItems; i++) {
+        if (version == 0 || ppItems[i]->version == version) {
+            printf("%u\t%u\t",
+                   ppItems[i]->version,
+                   (unsigned int) ppItems[i]->date);
+            print_action_name(ppItems[i]->action);
+            printf("\t%s\t%u\t%s\t",
+                   ppItems[i]->pActionBranch,
+                   ppItems[i]->actionVersion,
+                   ppItems[i]->pUsername);
+            print_escaped(ppItems[i]->pComment);
+            putchar('\n');
+        }
+    }
+}
+
+static SSCMResult query_file_history(struct SSCMContext *pContext, const char *pRepo, const char *pFile, unsigned int version)
+{
+    struct FileHistoryItem **ppItems = NULL;
+    int numOfHistoryItems = -1;
+
+    SSCMResult result = sscm_file_history(pContext,
+                                          pRepo,
+                                          pFile,
+                                          0, // No workflow state changes
+                                          0, // No custom field changes
+                                          AllActions,
+                                          &ppItems,
+                                          &numOfHistoryItems);
+    if (result == SSCM_API_OK) {
+        print_history_items(ppItems, numOfHistoryItems, version);
+    }
+
+    if (ppItems != NULL) {
+        sscm_free_history_itemlist(ppItems, numOfHistoryItems);
+    }
+
+    return result;
+}
+
+static int serve_queries(struct SSCMContext *pContext)
+{
+    char line[4096];
+
+    while (fgets(line, sizeof(line), stdin) != NULL) {
+        // strip the line ending, then split into branch, repo and file
+        line[strcspn(line, "\r\n")] = '\0';
+        char *pBranch = line;
+        char *pRepo = strchr(pBranch, '\t');
+        char *pFile = pRepo ? strchr(pRepo + 1, '\t') : NULL;
+        if (pFile == NULL) {
+            printf("ERROR\tmalformed query\n");
+            fflush(stdout);
+            continue;
+        }
+        *pRepo++ = '\0';
+        *pFile++ = '\0';
+
+        pContext->pBranch = pBranch;
+        SSCMResult result = query_file_history(pContext, pRepo, pFile, 0);
+        if (result != SSCM_API_OK) {
+            char *pError = sscm_get_last_error(result);
+            printf("ERROR\tsscm_file_history failed: %s\n", pError);
+            sscm_free_string(pError);
+        } else {
+            printf("END\n");
+        }
+        // the client waits for each answer before sending the next query
+        fflush(stdout);
+    }
+
+    return 0;
+}
+
 int main(int argc, char *argv[])
 {
     const char *pHost = NULL;
@@ -12,18 +168,24 @@ int main(int argc, char *argv[])
     const char *pFile = NULL;
     unsigned int version = 0;
     struct SSCMContext context;
-    struct FileHistoryItem **ppItems = NULL;
-    int numOfHistoryItems = -1;
     int ret = 1;
 
+    if (argc != 6 && argc < 9) {
+        fprintf(stderr, "usage: %s host port username password mainline [branch repo file [version]]\n", argv[0]);
+        return ret;
+    }
+
     pHost = argv[1];
     port = atoi(argv[2]);
     pUsername = argv[3];
     pPassword = argv[4];
     context.pMainline = argv[5];
-    context.pBranch = argv[6];
-    pRepo = argv[7];
-    pFile = argv[8];
+    context.pBranch = argv[5];
+    if (argc >= 9) {
+        context.pBranch = argv[6];
+        pRepo = argv[7];
+        pFile = argv[8];
+    }
     if (argc >= 10) {
         version = atoi(argv[9]);
     }
@@ -36,45 +198,28 @@ int main(int argc, char *argv[])
         sscm_free_string(pError);
         goto END;
     }
-    
-    result = sscm_file_history(&context,
-                               pRepo,
-                               pFile,
-                               0, // No workflow state changes
-                               0, // No custom field changes
-                               AllActions,
-                               &ppItems,
-                               &numOfHistoryItems);
+
+    if (pFile == NULL) {
+        // long-lived mode:  one connection, many queries
+        ret = serve_queries(&context);
+        goto END;
+    }
+
+    if (version == 0) {
+        printf("version\tdate\taction\tactionBranch\tactionVersion\tusername\tcomment\n");
+    }
+
+    result = query_file_history(&context, pRepo, pFile, version);
     if (result != SSCM_API_OK) {
         char *pError = sscm_get_last_error(result);
         printf("sscm_file_history failed: %s\n", pError);
         sscm_free_string(pError);
         goto END;
     }
-    
-    if (version == 0) {
-        printf("version\tdate\taction\tactionBranch\tactionVersion\tusername\n");
-    }
 
-    for (int i = 0; i < numOfHistoryItems; i++) {
-        if (version == 0 || ppItems[i]->version == version) {
-            printf("%u\t%u\t%d\t%s\t%u\t%s\n",
-                   ppItems[i]->version,
-                   (unsigned int) ppItems[i]->date,
-                   ppItems[i]->action,
-                   ppItems[i]->pActionBranch,
-                   ppItems[i]->actionVersion,
-                   ppItems[i]->pUsername);
-        }
-    }
-    
     ret = 0;
 
 END:
-    if (ppItems != NULL) {
-        sscm_free_history_itemlist(ppItems, numOfHistoryItems);
-    }
-
     sscm_disconnect(&context);
 
     return ret;
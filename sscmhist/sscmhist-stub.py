@@ -0,0 +1,55 @@
+#!/usr/bin/env python
+
+# sscmhist-stub.py
+#
+# Stand-in for the long-lived mode of sscmhist, for testing without a Surround server.
+# Answers queries from canned history instead of calling the Surround API.
+#
+# usage:
+#   sscmhist-stub.py history.json [host port username password] mainline
+#
+# history.json maps branch --> "repo/file" --> list of [version, date, action, actionBranch, actionVersion, username,
+# comment], using the same fields as the output of sscmhist (e.g. action "checkin", and the comment unescaped).  files
+# that are missing are answered with an error, like the real helper does for files it can't find.
+#
+# e.g.
+#   export-surround-to-git.py -m Sandbox -p Sandbox --history-backend sscmhist --sscmhist "sscmhist/sscmhist-stub.py history.json" parse
+
+
+from __future__ import print_function
+
+import sys
+import json
+
+
+def escape(text):
+    # same as print_escaped() in main.c
+    return text.replace('\\', '\\\\').replace('\t', '\\t').replace('\n', '\\n').replace('\r', '\\r')
+
+
+def main():
+    if len(sys.argv) < 3:
+        sys.stderr.write("usage: %s history.json [host port username password] mainline\n" % sys.argv[0])
+        sys.exit(1)
+
+    with open(sys.argv[1]) as f:
+        history = json.load(f)
+
+    for line in iter(sys.stdin.readline, ''):
+        fields = line.rstrip('\r\n').split('\t')
+        if len(fields) != 3:
+            print("ERROR\tmalformed query")
+        else:
+            branch, repo, file = fields
+            items = history.get(branch, {}).get("%s/%s" % (repo, file))
+            if items is None:
+                print("ERROR\tsscm_file_history failed: '%s/%s' not found on branch '%s'" % (repo, file, branch))
+            else:
+                for item in items:
+                    print('\t'.join([escape(str(field)) for field in item]))
+                print("END")
+        sys.stdout.flush()
+
+
+if __name__ == "__main__":
+    main()